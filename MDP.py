@@ -1,16 +1,21 @@
 # 马尔科夫决策过程
 
+import os
+import tempfile
+from contextlib import ExitStack, nullcontext
+import numpy as np
 # 设置转移概率， 奖励值以及它们的方法
 from utils import set_prob, set_reward, get_prob, get_reward
 # 设置状态价值， 策略概率以及读取它们的方法
 from utils import set_value, set_pi, get_value, get_pi
-from utils import display_dict, str_key
+from utils import display_dict, str_key, KeyTable, TabularPolicy
+from utils import save_arrays, load_arrays
 
 # 构建学生马尔科夫决策过程
 S = ['浏览手机中', '第一节课', '第二节课', '第三节课', '休息中']
 A = ['浏览手机', '学习', '离开浏览', '泡吧', '退出学习']
-R = {}  # 奖励Rsa字典
-P = {}  # 状态转移概率Pss'a字典
+R = KeyTable()  # 奖励Rsa字典
+P = KeyTable()  # 状态转移概率Pss'a字典
 gamma = 1.0  # 衰减因子
 # 根据学生马尔科夫决策过程示例的数据，设置状态转移概率和奖励， 默认概率为1
 set_prob(P, S[0], A[0], S[0])  # 浏览手机中 - 浏览手机 -> 浏览手机中
@@ -38,7 +43,7 @@ set_reward(R, S[3], A[3], +1)  # 第三节课  - 泡吧  -> +1
 MDP = (S, A, R, P, gamma)
 
 # 设置行为策略: Pi(a|.) = 0.5
-Pi = {}
+Pi = KeyTable()
 set_pi(Pi, S[0], A[0], 0.5)  # 浏览手机中  - 浏览手机
 set_pi(Pi, S[0], A[2], 0.5)  # 浏览手机中  - 离开浏览
 set_pi(Pi, S[1], A[0], 0.5)  # 第一节课  - 浏览手机
@@ -73,30 +78,90 @@ def compute_v(MDP, V, Pi, s):
     return v_s
 
 
+def sweep_V(MDP, V, backup, synchronous=False):
+    '''对所有状态做一次备份， 并统计这次备份中最大的贝尔曼残差
+    Args:
+        V 状态价值字典
+        backup 计算某状态新价值的函数 backup(MDP, V, s)
+        synchronous 为True时所有状态都使用备份前的价值计算(同步更新， 需要一个新的字典)，
+            否则直接在V上原地更新， 后面的状态会立刻用到前面状态的新值(Gauss-Seidel)
+    Returns:
+        tuple(V, delta) 更新后的价值字典以及最大残差 max|V'(s) - V(s)|
+    '''
+    S, _, _, _, _ = MDP
+    V_prime = V.copy() if synchronous else V
+    delta = 0
+    for s in S:
+        v = backup(MDP, V, s)
+        delta = max(delta, abs(v - get_value(V, s)))
+        set_value(V_prime, s, v)
+    return V_prime, delta
+
+
+# 使用profiler时统计调用次数的函数: 行为价值计算， 模型查询， 价值与策略查询
+PROFILED = ["compute_q", "compute_v", "get_prob", "get_reward", "get_value", "get_pi"]
+
+
+def profiling(profiler, *tables):
+    '''在with语句内让profiler统计本模块函数的调用次数， 以及tables中KeyTable构建字典键(str_key)的次数，
+    profiler为None时什么都不做
+    '''
+    stack = ExitStack()
+    if profiler is not None:
+        stack.enter_context(profiler.attach(globals(), PROFILED))
+        stack.enter_context(profiler.count_keys(*tables))
+    return stack
+
+
+def iterate(MDP, V, backup, n, theta=None, synchronous=False,
+            return_residuals=False, profiler=None):
+    '''反复调用sweep_V直到收敛
+    Args:
+        n 最大迭代次数
+        theta 收敛阈值， 某次迭代的最大残差小于theta时停止， 为None时固定迭代n次
+        synchronous 是否同步更新， 见sweep_V
+        return_residuals 是否同时返回每次迭代的最大残差
+        profiler utils.SolverProfiler， 统计调用次数以及每次迭代的耗时与残差
+    Returns:
+        V 或 tuple(V, residuals)
+    '''
+    V = V.copy()  # 只复制一次， 不修改传入的V
+    counters = getattr(V, "counters", None)
+    residuals = []
+    with profiling(profiler, MDP[2], MDP[3], V):
+        for i in range(n):
+            if profiler is not None:
+                profiler.start_sweep()
+            V, delta = sweep_V(MDP, V, backup, synchronous)
+            residuals.append(delta)
+            if profiler is not None:
+                profiler.end_sweep(delta, len(MDP[0]))
+            if theta is not None and delta < theta:
+                break
+    if profiler is not None and type(V) is KeyTable:
+        V.counters = counters  # 同步更新时V是迭代中复制得到的， 返回前不再让它计数
+    return (V, residuals) if return_residuals else V
+
+
 def update_V(MDP, V, Pi):
     '''
     根据当前策略使用回溯法来更新状态价值， 本章不做要求
     给定一个MDP和一个策略， 更新该策略下的价值函数V
     '''
-    S, _, _, _, _ = MDP
-    V_prime = V.copy()
-    for s in S:
-        # set_value(V_prime,s,V_S(MDP,V_prime,Pi,s))
-        V_prime[str_key(s)] = compute_v(MDP, V_prime, Pi, s)
-
+    V_prime, _ = sweep_V(MDP, V.copy(), lambda MDP, V, s: compute_v(MDP, V, Pi, s))
     return V_prime
 
 
-def policy_evaluate(MDP, V, Pi, n):
+def policy_evaluate(MDP, V, Pi, n, theta=None, synchronous=False,
+                    return_residuals=False, profiler=None):
     '''
     策略评估， 得到该策略下最终的状态价值， 本章不做要求
     使用n次迭代计算来评估一个MDP在给定策略Pi下的状态价值， 初始时价值为V
-
+    给定theta时， 最大残差小于theta即停止， n为最大迭代次数， 其余参数见iterate
     '''
-    for i in range(n):
-        V = update_V(MDP, V, Pi)
-        # display_dict(V)
-    return V
+    with nullcontext() if profiler is None else profiler.count_keys(Pi):
+        return iterate(MDP, V, lambda MDP, V, s: compute_v(MDP, V, Pi, s), n,
+                       theta, synchronous, return_residuals, profiler)
 
 
 def compute_v_from_max_q(MDP, V, s):
@@ -117,18 +182,230 @@ def update_V_without_pi(MDP, V):
     '''在不依赖策略的情况下， 直接通过后续状态的价值来更新状态价值
 
     '''
-    S, _, _, _, _ = MDP
-    V_prime = V.copy()
-    for s in S:
-        V_prime[str_key(s)] = compute_v_from_max_q(MDP, V_prime, s)
-
+    V_prime, _ = sweep_V(MDP, V.copy(), compute_v_from_max_q)
     return V_prime
 
 
-def value_iterate(MDP, V, n):
-    '''价值迭代'''
+def value_iterate(MDP, V, n, theta=None, synchronous=False,
+                  return_residuals=False, profiler=None):
+    '''价值迭代， 参数见iterate'''
+    return iterate(MDP, V, compute_v_from_max_q, n, theta, synchronous,
+                   return_residuals, profiler)
+
+
+# 将字典形式的MDP编译成numpy数组， 用张量运算完成整次迭代
+
+def index_map(X):
+    '''元素到其在列表中位置(索引)的字典, 编译后的数组即按此索引存取
+    '''
+    return {x: i for i, x in enumerate(X)}
+
+
+def _key_index(S, A):
+    '''生成 str_key(s) -> i 以及 str_key(s, a) -> (i, j) 的字典， 用于反查字典的键
+    '''
+    s_keys = {str_key(s): i for i, s in enumerate(S)}
+    sa_keys = {str_key(s, a): (i, j)
+               for i, s in enumerate(S) for j, a in enumerate(A)}
+    return s_keys, sa_keys
+
+
+def _split_sas_key(key, s_keys, sa_keys):
+    '''把形如 "s_a_s1" 的键拆分为 (i, j, k)， 状态或行为名本身可能含有"_"，
+    因此依次尝试每一个分隔位置
+    '''
+    pos = key.find("_")
+    while pos >= 0:
+        prefix, suffix = key[:pos], key[pos+1:]
+        if prefix in sa_keys and suffix in s_keys:
+            return sa_keys[prefix] + (s_keys[suffix],)
+        pos = key.find("_", pos+1)
+    return None
+
+
+def compile_mdp(MDP):
+    '''把以字符串为键的字典形式的MDP编译为numpy数组， 每个字典只遍历一次
+    Args:
+        MDP 五元组 (S, A, R, P, gamma)， R, P 为字典
+    Returns:
+        五元组 (S, A, R, P, gamma)， 其中
+            R 奖励数组 shape(nS, nA), R[s,a]
+            P 状态转移概率数组 shape(nS, nA, nS), P[s,a,s']
+        状态和行为在S, A中的位置即为其索引， 见index_map
+    '''
+    S, A, R, P, gamma = MDP
+    s_keys, sa_keys = _key_index(S, A)
+    R_arr = np.zeros((len(S), len(A)))
+    P_arr = np.zeros((len(S), len(A), len(S)))
+    for key, r in R.items():
+        if key in sa_keys:
+            R_arr[sa_keys[key]] = r
+    for key, p in P.items():
+        ijk = _split_sas_key(key, s_keys, sa_keys)
+        if ijk is not None:
+            P_arr[ijk] = p
+    return S, A, R_arr, P_arr, gamma
+
+
+def compile_pi(Pi, S, A):
+    '''把策略字典或TabularPolicy编译为数组 pi shape(nS, nA), pi[s,a]
+    '''
+    if isinstance(Pi, TabularPolicy):
+        if Pi.S == list(S) and Pi.A == list(A):
+            return Pi.pi.copy()
+        return TabularPolicy.from_dict(Pi.to_dict(), S, A).pi
+    _, sa_keys = _key_index(S, A)
+    pi = np.zeros((len(S), len(A)))
+    for key, p in Pi.items():
+        if key in sa_keys:
+            pi[sa_keys[key]] = p
+    return pi
+
+
+def save_mdp(path, cMDP, **arrays):
+    '''把编译后的MDP保存到目录path， 可以同时保存求解得到的数组， 比如 V=V, pi=pi
+    状态与行为需要可以序列化为JSON
+    '''
+    S, A, R, P, gamma = cMDP
+    save_arrays(path, dict(arrays, R=R, P=P),
+                {"type": "MDP", "S": list(S), "A": list(A), "gamma": float(gamma)})
+
+
+def load_mdp(path, mmap=True):
+    '''读取save_mdp保存的MDP， 不需要重新构建字典或编译
+    Args:
+        mmap 为True时内存映射数组， 只在访问时读取
+    Returns:
+        tuple(cMDP, arrays) arrays为与MDP一起保存的其他数组
+    '''
+    arrays, meta = load_arrays(path, mmap)
+    R, P = arrays.pop("R"), arrays.pop("P")
+    return (meta["S"], meta["A"], R, P, meta["gamma"]), arrays
+
+
+def V_to_dict(cMDP, V):
+    '''把价值数组转换回价值字典， 以便使用display_dict等方法
+    '''
+    S = cMDP[0]
+    V_dict = {}
+    for s, v in zip(S, V):
+        set_value(V_dict, s, float(v))
+    return V_dict
+
+
+def compute_q_tensor(cMDP, V):
+    '''一次张量收缩计算所有状态行为对的价值 q[s,a] (公式 2.16)
+    '''
+    _, _, R, P, gamma = cMDP
+    return R + gamma * np.tensordot(P, V, axes=([2], [0]))
+
+
+def greedy_policy_tensor(cMDP, V):
+    '''根据状态价值数组得到贪婪策略TabularPolicy
+    '''
+    S, A = cMDP[0], cMDP[1]
+    return TabularPolicy.greedy(S, A, compute_q_tensor(cMDP, V))
+
+
+def policy_evaluate_tensor(cMDP, V, pi, n, theta=None, return_residuals=False,
+                           profiler=None):
+    '''策略评估的数组版本, 每次迭代为一次矩阵向量乘法
+    先求出策略pi下的状态转移矩阵 P_pi[s,s'] 和奖励 r_pi[s]， 之后每次迭代为
+        V = r_pi + gamma * P_pi V
+    注意: 与update_V边算边用新值的方式不同， 这里每次迭代都只使用上一次的V(同步更新)，
+    收敛到的价值相同
+    Args:
+        cMDP 由compile_mdp编译得到的MDP
+        V 初始价值数组 shape(nS,)， 为None时全部为0
+        pi 策略数组 shape(nS, nA)
+        n 最大迭代次数
+        theta, return_residuals, profiler 见iterate
+    Returns:
+        V 价值数组 shape(nS,) 或 tuple(V, residuals)
+    '''
+    S, _, R, P, gamma = cMDP
+    V = np.zeros(len(S)) if V is None else np.array(V, dtype=float)
+    P_pi = np.einsum('sa,sat->st', pi, P)
+    r_pi = (pi * R).sum(axis=1)
+    residuals = []
+    for i in range(n):
+        if profiler is not None:
+            profiler.start_sweep()
+        V_prime = r_pi + gamma * P_pi.dot(V)
+        residuals.append(float(np.abs(V_prime - V).max(initial=0)))
+        V = V_prime
+        if profiler is not None:
+            profiler.end_sweep(residuals[-1], len(S))
+        if theta is not None and residuals[-1] < theta:
+            break
+    return (V, residuals) if return_residuals else V
+
+
+def value_iterate_tensor(cMDP, V, n, theta=None, return_residuals=False,
+                         profiler=None):
+    '''价值迭代的数组版本， 每次迭代为一次张量收缩加上按行取最大值
+    Args:
+        cMDP 由compile_mdp编译得到的MDP
+        V 初始价值数组 shape(nS,)， 为None时全部为0
+        n 最大迭代次数
+        theta, return_residuals, profiler 见iterate
+    Returns:
+        V 价值数组 shape(nS,) 或 tuple(V, residuals)
+    '''
+    S = cMDP[0]
+    V = np.zeros(len(S)) if V is None else np.array(V, dtype=float)
+    residuals = []
     for i in range(n):
-        V = update_V_without_pi(MDP, V)
+        if profiler is not None:
+            profiler.start_sweep()
+        V_prime = compute_q_tensor(cMDP, V).max(axis=1)
+        residuals.append(float(np.abs(V_prime - V).max(initial=0)))
+        V = V_prime
+        if profiler is not None:
+            profiler.end_sweep(residuals[-1], len(S))
+        if theta is not None and residuals[-1] < theta:
+            break
+    return (V, residuals) if return_residuals else V
+
+
+def policy_evaluate_batch(cMDP, pis, gammas=None, n=None, theta=None):
+    '''批量策略评估: 在一次广播的张量运算中同时评估多个策略与多个衰减因子
+    Args:
+        cMDP 由compile_mdp编译得到的MDP
+        pis 策略数组 shape(nP, nS, nA)， 也可以是单个策略 shape(nS, nA) 或TabularPolicy的列表
+        gammas 衰减因子 shape(nG,) 或标量， 为None时使用cMDP中的gamma
+        n 为None时对每一组(策略, 衰减因子)直接求解线性方程组 (I - gamma * P_pi) V = r_pi，
+          否则同步迭代最多n次; 衰减因子为1且策略不能到达终止状态时方程组没有解， 只能迭代
+        theta 迭代时所有组合的最大残差小于theta即停止
+    Returns:
+        V 价值数组 shape(nP, nG, nS)， V[i, j] 为第i个策略在第j个衰减因子下的状态价值
+    Raises:
+        np.linalg.LinAlgError n为None而某一组(策略, 衰减因子)的方程组没有唯一解
+    '''
+    S, _, R, P, gamma = cMDP
+    pis = np.asarray(pis, dtype=float)
+    if pis.ndim == 2:
+        pis = pis[np.newaxis]
+    gammas = np.atleast_1d(np.asarray(gamma if gammas is None else gammas, dtype=float))
+    P_pi = np.einsum('psa,sat->pst', pis, P)  # shape(nP, nS, nS)
+    r_pi = (pis * R).sum(axis=2)  # shape(nP, nS)
+    g = gammas[np.newaxis, :, np.newaxis]
+    if n is None:
+        M = np.eye(len(S)) - g[..., np.newaxis] * P_pi[:, np.newaxis]
+        b = np.broadcast_to(r_pi[:, np.newaxis], M.shape[:-1])
+        try:
+            return np.linalg.solve(M, b[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            raise np.linalg.LinAlgError(
+                "有策略的价值没有唯一解(衰减因子为1且该策略无法到达终止状态), "
+                "可以给定n做迭代评估") from None
+    V = np.zeros((len(pis), len(gammas), len(S)))
+    for i in range(n):
+        V_prime = r_pi[:, np.newaxis] + g * np.einsum('pst,pgt->pgs', P_pi, V)
+        residual = np.abs(V_prime - V).max(initial=0)
+        V = V_prime
+        if theta is not None and residual < theta:
+            break
     return V
 
 
@@ -146,7 +423,7 @@ def main():
     print("----状态价值函数：----")
 
     # 状态价值函数
-    V = {}
+    V = KeyTable()
     display_dict(V)
 
     V = policy_evaluate(MDP, V, Pi, 100)
@@ -154,10 +431,11 @@ def main():
     v = compute_v(MDP, V, Pi, "第三节课")
     print("第三节课在当前策略下的最终价值为:{:.2f}".format(v))
     # 状态价值函数
-    V = {}
+    V = KeyTable()
     # 通过价值迭代得到 最优状态价值
-    V_star = value_iterate(MDP, V, 4)
-    print("-----通过价值迭代得到 最优状态价值-----")
+    V_star, residuals = value_iterate(MDP, V, 100, theta=1e-4,
+                                      return_residuals=True)
+    print("-----通过价值迭代得到 最优状态价值(迭代{}次)-----".format(len(residuals)))
     display_dict(V_star)
 
     # 验证最优行为价值
@@ -165,6 +443,36 @@ def main():
     q = compute_q(MDP, V_star, s, a)
     print("在状态{}选择行为{}的最优价值为{:.2f}".format(s, a, q))
 
+    # 编译成数组后， 用张量运算完成策略评估与价值迭代
+    cMDP = compile_mdp(MDP)
+    pi = compile_pi(Pi, S, A)
+    print("-----数组版本的策略评估-----")
+    display_dict(V_to_dict(cMDP, policy_evaluate_tensor(cMDP, None, pi, 100)))
+    print("-----数组版本的价值迭代-----")
+    display_dict(V_to_dict(cMDP, value_iterate_tensor(cMDP, None, 4)))
+
+    # 以数组保存的策略可以直接代替策略字典
+    policy = TabularPolicy.from_dict(Pi, S, A)
+    print("-----TabularPolicy的策略评估-----")
+    display_dict(policy_evaluate(MDP, KeyTable(), policy, 100))
+    print("-----最优价值对应的贪婪策略-----")
+    greedy = greedy_policy_tensor(cMDP, value_iterate_tensor(cMDP, None, 100))
+    display_dict(greedy.to_dict())
+
+    # 一次评估多个策略在多个衰减因子下的价值
+    gammas = [0.5, 0.9, 1.0]
+    values = policy_evaluate_batch(cMDP, [policy, greedy], gammas)
+    print("-----批量策略评估: 第三节课的价值-----")
+    for name, v in zip(["Pi", "贪婪策略"], values[:, :, S.index("第三节课")]):
+        print(name, " ".join("gamma={}: {:.2f}".format(g, x) for g, x in zip(gammas, v)))
+
+    # 保存编译后的模型与求解结果， 之后可以直接读取， 不必重新构建和求解
+    path = os.path.join(tempfile.gettempdir(), "student_mdp")
+    save_mdp(path, cMDP, V=value_iterate_tensor(cMDP, None, 100), pi=greedy.pi)
+    cMDP, solved = load_mdp(path)
+    print("-----读取保存的最优价值-----")
+    display_dict(V_to_dict(cMDP, solved["V"]))
+
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,15 @@
 
 # 马尔科夫奖励过程
 
+import warnings
 import numpy as np
+try:  # scipy为可选依赖， 用于LU分解以及稀疏矩阵求解
+    from scipy import linalg as sla
+    from scipy import sparse
+    from scipy.sparse import linalg as spla
+except ImportError:
+    sla, sparse, spla = None, None, None
+
 num_states=7
 #{"0":"C1","1":"C2","2":"C3","3":"Pass","4":"Pub","5":"FB","6":"Sleep"}
 i_to_n={}#索引到状态名的字典
@@ -53,21 +61,151 @@ def compute_return(start_index=0,chain=None, gamma=0.5) -> float:
     return retrn
 
 
+def encode_chain(chain):
+    '''把由状态名组成的链转换为状态索引数组， 已经是整数索引的链直接转换为数组'''
+    if len(chain) > 0 and isinstance(chain[0], str):
+        return np.array([n_to_i[name] for name in chain], dtype=int)
+    return np.asarray(chain, dtype=int)
+
+
+def compute_returns(chains, gamma=0.5, rewards=rewards):
+    '''批量计算多条链中每一个位置的收获值, 从链尾向前扫描 G_t = R_t + gamma * G_t+1
+    所有链补齐到相同长度后按列同时计算， 补齐部分的奖励为0， 不影响结果
+    Args:
+        chains 多条马尔科夫链， 可以是状态名或状态索引组成的list(长度可以不同)，
+               或者shape(B,T)的整数索引数组
+        gamma 衰减系数
+        rewards 各状态的即时奖励
+    Returns:
+        chains为二维数组时返回shape(B,T)的数组，
+        否则返回list, 第i个元素为chains[i]各个位置的收获值 shape(len(chains[i]),)
+    '''
+    rewards = np.asarray(rewards, dtype=float)
+    if isinstance(chains, np.ndarray) and chains.ndim == 2:
+        return _reverse_scan(rewards[chains], gamma)
+
+    encoded = [encode_chain(chain) for chain in chains]
+    lengths = [len(chain) for chain in encoded]
+    R = np.zeros((len(encoded), max(lengths, default=0)))
+    for i, chain in enumerate(encoded):
+        R[i, :len(chain)] = rewards[chain]
+    G = _reverse_scan(R, gamma)
+    return [G[i, :n] for i, n in enumerate(lengths)]
+
+
+def _reverse_scan(R, gamma):
+    '''对shape(B,T)的奖励矩阵按时间倒序累积有衰减的奖励'''
+    G = np.zeros_like(R)
+    g = np.zeros(R.shape[0])
+    for t in range(R.shape[1]-1, -1, -1):
+        g = R[:, t] + gamma * g
+        G[:, t] = g
+    return G
+
+
+def iter_returns(chains, gamma=0.5, rewards=rewards, batch_size=1024):
+    '''以流的方式处理大量的链， 每凑够batch_size条链调用一次compute_returns
+    Args:
+        chains 可迭代的链， 例如逐行读取轨迹日志的生成器
+    Yields:
+        每条链各个位置的收获值 shape(len(chain),)
+    '''
+    batch = []
+    for chain in chains:
+        batch.append(chain)
+        if len(batch) == batch_size:
+            yield from compute_returns(batch, gamma, rewards)
+            batch = []
+    if batch:
+        yield from compute_returns(batch, gamma, rewards)
+
+
 def compute_value(Pss, rewards, gamma=0.05 ):
     '''通过求解矩阵方程的形式直接计算状态的价值
     Args:
-        Pss  状态转移概率矩阵 shape(7,7)
+        Pss  状态转移概率矩阵 shape(n,n)
         rewards 即时奖励 list
         gamma 衰减系数 
     Return 
-        values 各状态的价值
+        values 各状态的价值 shape(n,1)
     '''
     assert(gamma >= 0 and gamma <= 1.0)
     #将rewards转为numpy数组并修改为列向量的形式
     rewards = np.array(rewards).reshape((-1,1))
-    #np.eye(7,7)为单位矩阵，    inv方法为求矩阵的逆
-    values = np.dot(np.linalg.inv(np.eye(7,7) - gamma * Pss) , rewards)
-    return values
+    # 求解 (I - gamma * Pss) v = rewards, 不显式求逆矩阵
+    return solve_values(Pss, rewards, gamma)
+
+
+_SINGULAR = "矩阵 I - gamma * Pss 奇异(gamma={}), 价值没有唯一解"
+
+
+def solve_values(Pss, rewards, gammas=0.5, method="direct", theta=1e-10,
+                 max_iter=10000):
+    '''求解 (I - gamma * Pss) v = r, 状态数任意， 可以一次求解多个奖励向量和多个衰减系数
+    对于每一个gamma只做一次矩阵分解， 所有的奖励向量共用这次分解
+    Args:
+        Pss 状态转移概率矩阵 shape(n,n), 可以是numpy数组或scipy稀疏矩阵
+        rewards 即时奖励 shape(n,) 或 shape(n,k)， 每一列为一个奖励向量
+        gammas 衰减系数， 一个数或一组数
+        method "direct"  稠密矩阵的LU分解(没有scipy时使用np.linalg.solve)
+               "sparse"  稀疏矩阵的LU分解， 需要scipy
+               "iterative" 迭代 v = r + gamma * Pss v 直到变化小于theta, 适用于很大的稀疏矩阵，
+                           要求gamma < 1 (或所有循环上的奖励为0)
+        theta, max_iter  迭代法的收敛阈值与最大迭代次数
+    Returns:
+        values 若gammas为一个数， shape与rewards相同; 否则在最前面增加一维 shape(len(gammas), ...)
+    Raises:
+        np.linalg.LinAlgError 方程组没有唯一解(比如gamma为1)， 或者迭代max_iter次仍未收敛
+    '''
+    scalar_gamma = np.ndim(gammas) == 0
+    gammas = np.atleast_1d(gammas)
+    assert(np.all(gammas >= 0) and np.all(gammas <= 1.0))
+    rewards = np.asarray(rewards, dtype=float)
+    n = Pss.shape[0]
+    assert(rewards.shape[0] == n)
+
+    values = []
+    for gamma in gammas:
+        if method == "direct":
+            P_dense = Pss.toarray() if hasattr(Pss, "toarray") else np.asarray(Pss)
+            A = np.eye(n) - gamma * P_dense
+            if sla is not None:
+                with warnings.catch_warnings():  # 奇异时lu_factor只给出警告， 这里检查主元后抛出异常
+                    warnings.simplefilter("ignore", sla.LinAlgWarning)
+                    lu, piv = sla.lu_factor(A)
+                if np.any(np.diag(lu) == 0):
+                    raise np.linalg.LinAlgError(_SINGULAR.format(gamma))
+                values.append(sla.lu_solve((lu, piv), rewards))
+            else:
+                try:
+                    values.append(np.linalg.solve(A, rewards))
+                except np.linalg.LinAlgError:
+                    raise np.linalg.LinAlgError(_SINGULAR.format(gamma)) from None
+        elif method == "sparse":
+            if spla is None:
+                raise ImportError("method='sparse' 需要安装scipy")
+            A = sparse.identity(n, format="csc") - gamma * sparse.csc_matrix(Pss)
+            try:
+                values.append(spla.splu(A).solve(rewards))
+            except RuntimeError:  # splu在矩阵奇异时抛出RuntimeError
+                raise np.linalg.LinAlgError(_SINGULAR.format(gamma)) from None
+        elif method == "iterative":
+            v = np.zeros_like(rewards)
+            for i in range(max_iter):
+                v_prime = rewards + gamma * Pss.dot(v)
+                delta = np.abs(v_prime - v).max(initial=0)
+                v = v_prime
+                if delta < theta:
+                    break
+            else:
+                raise np.linalg.LinAlgError(
+                    "迭代{}次仍未收敛(gamma={}), 迭代法要求gamma < 1".format(max_iter, gamma))
+            values.append(v)
+        else:
+            raise ValueError("未知的求解方法:{}".format(method))
+
+    return values[0] if scalar_gamma else np.stack(values)
+
 
 if __name__ == "__main__":
     
@@ -83,6 +221,9 @@ if __name__ == "__main__":
     print(compute_return(0,chains[3] , gamma=0.5))
     # 位置1 ,修改参数来验证其它收获值
     print(compute_return(1,chains[3] , gamma=0.5))
+    # 一次计算所有链中每个位置的收获值
+    for G in compute_returns(chains, gamma=0.5):
+        print(G[0])
 
     # 求解状态的价值
      #计算这类问题的复杂度为O(n3)
@@ -94,4 +235,7 @@ if __name__ == "__main__":
     # [ 10.        ]
     # [  0.80308417]
     # [-22.53857963]
-    # [  0.        ]]
\ No newline at end of file
+    # [  0.        ]]
+
+    # 一次求解多个衰减系数下的价值
+    print(solve_values(Pss, rewards, gammas=[0.5, 0.9, 0.99]))
\ No newline at end of file
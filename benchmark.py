@@ -0,0 +1,233 @@
+# 性能基准测试: 对各章节的求解器与模拟器计时， 结果以JSON输出， 便于在不同提交之间比较
+#
+# 用法:
+#   python benchmark.py                          运行全部基准， 结果输出到终端
+#   python benchmark.py --only mdp ch03 -o bench.json
+#   python benchmark.py --sizes 50 200 800 --repeat 5
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import MRP
+import MDP
+import ch03
+import ch04
+import gridworld
+import parallel
+from utils import KeyTable, TabularPolicy, set_prob, set_reward, set_pi
+
+
+def timeit(fn, repeat=3):
+    '''运行repeat次fn， 返回最短的耗时(秒)'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def random_transition_matrix(n, rng, k=3):
+    '''每个状态随机转移到k个后续状态的状态转移概率矩阵 shape(n,n)'''
+    Pss = np.zeros((n, n))
+    for i in range(n):
+        Pss[i, rng.choice(n, size=min(k, n), replace=False)] = rng.dirichlet(np.ones(min(k, n)))
+    return Pss
+
+
+def random_dict_mdp(n, rng, num_actions=4, k=3):
+    '''构建一个以KeyTable存储的随机MDP以及均一随机策略， 格式与MDP.py中的学生MDP相同'''
+    S = ["s{}".format(i) for i in range(n)]
+    A = ["a{}".format(i) for i in range(num_actions)]
+    R, P, Pi = KeyTable(), KeyTable(), KeyTable()
+    for s in S:
+        for a in A:
+            successors = rng.choice(n, size=min(k, n), replace=False)
+            for s1, p in zip(successors, rng.dirichlet(np.ones(len(successors)))):
+                set_prob(P, s, a, S[s1], p)
+            set_reward(R, s, a, float(rng.normal()))
+            set_pi(Pi, s, a, 1.0 / num_actions)
+    return (S, A, R, P, 0.9), Pi
+
+
+def bench_mrp(sizes, repeat, rng):
+    records = []
+    for n in sizes:
+        Pss = random_transition_matrix(n, rng)
+        rewards = rng.normal(size=n)
+        records.append(("MRP.compute_value", n, timeit(
+            lambda: MRP.compute_value(Pss, rewards, gamma=0.9), repeat)))
+        chain = [MRP.i_to_n[str(i)] for i in rng.integers(0, MRP.num_states, size=n)]
+        records.append(("MRP.compute_return", n, timeit(
+            lambda: [MRP.compute_return(i, chain, 0.5) for i in range(0, n, max(1, n // 10))],
+            repeat)))
+        chains = [chain] * 100
+        records.append(("MRP.compute_returns[100 chains]", n, timeit(
+            lambda: MRP.compute_returns(chains, 0.5), repeat)))
+    return records
+
+
+def bench_mdp(sizes, repeat, rng, sweeps=10, max_dict_states=200):
+    # 字典版本每次迭代的耗时与状态数的平方成正比， 只对不超过max_dict_states的规模计时
+    records = [
+        ("MDP.policy_evaluate[student]", len(MDP.S), timeit(
+            lambda: MDP.policy_evaluate(MDP.MDP, KeyTable(), MDP.Pi, 100), repeat)),
+        ("MDP.value_iterate[student]", len(MDP.S), timeit(
+            lambda: MDP.value_iterate(MDP.MDP, KeyTable(), 100), repeat)),
+    ]
+    for n in sizes:
+        model, Pi = random_dict_mdp(n, rng)
+        if n <= max_dict_states:
+            records.append(("MDP.policy_evaluate[{} sweeps]".format(sweeps), n, timeit(
+                lambda: MDP.policy_evaluate(model, KeyTable(), Pi, sweeps), 1)))
+            records.append(("MDP.value_iterate[{} sweeps]".format(sweeps), n, timeit(
+                lambda: MDP.value_iterate(model, KeyTable(), sweeps), 1)))
+        records.append(("MDP.compile_mdp", n, timeit(lambda: MDP.compile_mdp(model), repeat)))
+        cMDP = MDP.compile_mdp(model)
+        pi = MDP.compile_pi(Pi, model[0], model[1])
+        with tempfile.TemporaryDirectory() as path:
+            MDP.save_mdp(path, cMDP, pi=pi)
+            records.append(("MDP.load_mdp", n, timeit(lambda: MDP.load_mdp(path), repeat)))
+            records.append(("MDP.load_mdp[mmap=False]", n, timeit(
+                lambda: MDP.load_mdp(path, mmap=False), repeat)))
+        records.append(("MDP.policy_evaluate_tensor[{} sweeps]".format(sweeps), n, timeit(
+            lambda: MDP.policy_evaluate_tensor(cMDP, None, pi, sweeps), repeat)))
+        records.append(("MDP.value_iterate_tensor[{} sweeps]".format(sweeps), n, timeit(
+            lambda: MDP.value_iterate_tensor(cMDP, None, sweeps), repeat)))
+        pis = rng.dirichlet(np.ones(len(model[1])), size=(10, n))
+        records.append(("MDP.policy_evaluate_batch[10 pi x 5 gamma, {} sweeps]".format(sweeps), n,
+                        timeit(lambda: MDP.policy_evaluate_batch(
+                            cMDP, pis, np.linspace(0.5, 0.9, 5), sweeps), repeat)))
+    return records
+
+
+def bench_ch03(sizes, repeat, rng, sweeps=10):
+    # 规模为状态数， 使用边长约为sqrt(规模)的方格世界(ch03.make_grid_mdp)， 记录实际的状态数
+    records = []
+    for size in sizes:
+        side = max(2, int(round(size ** 0.5)))
+        model = ch03.make_grid_mdp(side)
+        S, A = model[0], model[1]
+        n = len(S)
+        V = [0 for _ in S]
+        pis = rng.dirichlet(np.ones(len(A)), size=(10, n))
+        records += [
+            ("ch03.compile_dynamics", n, timeit(
+                lambda: ch03.compile_dynamics(ch03.make_grid_mdp(side)), repeat)),
+            ("ch03.policy_evaluate[uniform, {} sweeps]".format(sweeps), n, timeit(
+                lambda: ch03.policy_evaluate(model, V, ch03.uniform_random_pi, sweeps), repeat)),
+            ("ch03.policy_evaluate[TabularPolicy, {} sweeps]".format(sweeps), n, timeit(
+                lambda: ch03.policy_evaluate(model, V, TabularPolicy.uniform(S, A), sweeps), repeat)),
+            ("ch03.policy_iterate[1x{}]".format(sweeps), n, timeit(
+                lambda: ch03.policy_iterate(model, V, ch03.greedy_pi, 1, sweeps), repeat)),
+            ("ch03.policy_iterate_table[exact]", n, timeit(
+                lambda: ch03.policy_iterate_table(model), repeat)),
+            ("ch03.policy_iterate_table[k=3]", n, timeit(
+                lambda: ch03.policy_iterate_table(model, k=3), repeat)),
+            ("ch03.policy_evaluate_batch[10 pi x 5 gamma, {} sweeps]".format(sweeps), n, timeit(
+                lambda: ch03.policy_evaluate_batch(model, pis, np.linspace(0.5, 0.9, 5), sweeps),
+                repeat)),
+            ("ch03.value_iterate[theta=1e-4]", n, timeit(
+                lambda: ch03.value_iterate(model, V, 10 * side, theta=1e-4), repeat)),
+            ("ch03.prioritized_value_iterate", n, timeit(
+                lambda: ch03.prioritized_value_iterate(model, V), repeat)),
+        ]
+    return records
+
+
+def bench_grid(sizes, repeat, rng, sweeps=20):
+    # 规模为方格世界的边长， 带10%的随机障碍物与滑动
+    records = []
+    for n in sizes:
+        grid = gridworld.GridWorld(n, n, obstacles=rng.random((n, n)) < 0.1, slip=0.1, gamma=0.9)
+        for name, fn in (("value_iterate", grid.value_iterate), ("policy_evaluate", grid.policy_evaluate)):
+            seconds = timeit(lambda: fn(n=sweeps, theta=None), repeat)
+            records.append(("gridworld.{}[{} sweeps]".format(name, sweeps), n, seconds,
+                            {"states_per_second": n * n * sweeps / seconds}))
+        model = grid.successors()
+        for mode in parallel.MODES:
+            seconds = timeit(lambda: parallel.value_iterate_parallel(*model, n=sweeps, theta=None,
+                                                                     mode=mode), repeat)
+            records.append(("parallel.value_iterate_parallel[{}, {} sweeps]".format(mode, sweeps), n,
+                            seconds, {"states_per_second": n * n * sweeps / seconds,
+                                      "workers": os.cpu_count()}))
+    return records
+
+
+def bench_ch04(sizes, repeat, rng, num=20000):
+    A = ["继续叫牌", "停止叫牌"]
+
+    def play_arena():
+        arena = ch04.Arena(A=A, seed=0, keep_episodes=False)
+        arena.play_games(ch04.Dealer(A=A), ch04.Player(A=A), num=num,
+                         show_statistic=False, show_progress=False)
+
+    def play_batch():
+        ch04.BatchArena(A=A, seed=0).play_batch(num)
+
+    records = []
+    for name, fn in (("ch04.Arena.play_games", play_arena),
+                     ("ch04.BatchArena.play_batch", play_batch)):
+        seconds = timeit(fn, repeat)
+        records.append((name, num, seconds, {"hands_per_second": num / seconds}))
+    return records
+
+
+BENCHMARKS = {"mrp": bench_mrp, "mdp": bench_mdp, "ch03": bench_ch03, "ch04": bench_ch04,
+              "grid": bench_grid}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, sizes, repeat, seed=0):
+    '''运行指定的基准测试， 返回可以直接序列化为JSON的结果'''
+    rng = np.random.default_rng(seed)
+    results = []
+    for name in names:
+        for record in BENCHMARKS[name](sizes, repeat, rng):
+            benchmark, size, seconds = record[:3]
+            result = {"benchmark": benchmark, "size": size, "seconds": seconds}
+            if len(record) > 3:
+                result.update(record[3])
+            results.append(result)
+    return {"revision": git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "repeat": repeat,
+            "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="强化学习各章节求解器与模拟器的性能基准")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), default=list(BENCHMARKS),
+                        help="只运行指定的基准")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[50, 200, 800],
+                        help="问题的规模(状态数、链长或方格世界的边长)")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复的次数， 取最短耗时")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="把JSON结果写入该文件")
+    args = parser.parse_args()
+
+    report = run(args.only, args.sizes, args.repeat, args.seed)
+    for result in report["results"]:
+        print("{:<50} {:>8} {:>12.6f}s".format(result["benchmark"], result["size"], result["seconds"]))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
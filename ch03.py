@@ -1,6 +1,14 @@
 
 # 编程实践， 动态规划求解小型方格世界最优策略
 
+import heapq
+import os
+import tempfile
+from contextlib import nullcontext
+import numpy as np
+from utils import TabularPolicy
+from MDP import policy_evaluate_batch as policy_evaluate_batch_tensor
+from MDP import save_mdp, load_mdp
 
 S = [i for i in range(16)]  # 状态空间
 A = ["n", "e", "s", "w"]  # 行为空间
@@ -46,10 +54,95 @@ def R(s, a):  # 奖励函数
     return r
 
 
+# R与P由dynamics生成， compile_dynamics直接调用dynamics， 对每个状态行为对只调用一次
+P.dynamics = R.dynamics = dynamics
+
 gamma = 1.00
 MDP = S, A, R, P, gamma  # MDP拥有五个元素的元组, 只不过R和P都变成了函数， 而不是字典
 
 
+def make_grid_mdp(width, height=None, gamma=1.0):
+    '''规则与上面的4x4方格世界相同、大小为width x height的方格世界MDP, 左上角与右下角为终止状态
+    Returns: tuple(S, A, R, P, gamma), R与P的dynamics属性为该方格世界的环境动力学
+    '''
+    height = width if height is None else height
+    last = width * height - 1
+    moves = {"n": (-1, 0), "e": (0, 1), "s": (1, 0), "w": (0, -1)}
+
+    def grid_dynamics(s, a):
+        if s in (0, last):
+            return s, 0, True
+        row, col = divmod(s, width)
+        dr, dc = moves[a]
+        if 0 <= row + dr < height and 0 <= col + dc < width:
+            s = (row + dr) * width + col + dc
+        return s, -1, False
+
+    def grid_P(s, a, s1):
+        return s1 == grid_dynamics(s, a)[0]
+
+    def grid_R(s, a):
+        return grid_dynamics(s, a)[1]
+
+    grid_P.dynamics = grid_R.dynamics = grid_dynamics
+    return list(range(width * height)), list(A), grid_R, grid_P, gamma
+
+
+_tables = {}  # 已编译的环境动力学表, 以(id(S), id(A), R, P, dynamics)为键， 值中保留S与A使id不被复用
+
+
+def compile_dynamics(MDP, dynamics=None):
+    '''对每一个状态行为对(s,a)只调用一次环境动力学dynamics(s, a)， 把后续状态、奖励与是否终止缓存为数组，
+    同一(S, A, R, P)只编译一次， 之后每次查找的开销与状态数无关(编译后不应再修改S与A)。
+    状态s本身即为数组的行索引
+    Args:
+        dynamics 环境动力学 dynamics(s, a) -> tuple(s_prime, reward, is_end)，
+            为None时使用P的dynamics属性(P由dynamics生成时， 比如本模块的P与make_grid_mdp)。
+            R不是由同一个dynamics生成时， 奖励仍然通过R获取， 每个状态行为对调用一次。
+            没有dynamics时只能对每个s1查询P(s, a, s1)， 编译的耗时与状态数的平方成正比，
+            此时状态转移需要是确定性的， 所有行为都回到自身且奖励为0的状态视为终止状态
+    Returns: tuple(a_to_i, next_s, rewards, is_end)
+            a_to_i 行为到列索引的字典
+            next_s 后续状态 shape(nS, nA)
+            rewards 奖励值 shape(nS, nA)
+            is_end 是否为终止状态 shape(nS, nA)
+    '''
+    S, A, R, P, _ = MDP
+    key = (id(S), id(A), R, P, dynamics)
+    entry = _tables.get(key)
+    if entry is None:
+        entry = _tables[key] = S, A, _compile_dynamics(S, A, R, P, dynamics)
+    return entry[2]
+
+
+def _compile_dynamics(S, A, R, P, dynamics):
+    if dynamics is None:
+        dynamics = getattr(P, "dynamics", None)
+    next_s = np.zeros((len(S), len(A)), dtype=int)
+    rewards = np.zeros((len(S), len(A)))
+    is_end = np.zeros((len(S), len(A)), dtype=bool)
+    if dynamics is not None:
+        own_reward = getattr(R, "dynamics", None) is dynamics
+        for s in S:
+            for i, a in enumerate(A):
+                next_s[s, i], r, is_end[s, i] = dynamics(s, a)
+                rewards[s, i] = r if own_reward else get_reward(R, s, a)
+    else:
+        for s in S:
+            for i, a in enumerate(A):
+                successors = [(s1, get_prob(P, s, a, s1)) for s1 in S]
+                successors = [(s1, p) for s1, p in successors if p]
+                if len(successors) != 1 or successors[0][1] != 1:
+                    raise ValueError("compile_dynamics只支持确定性的状态转移: "
+                                     "状态{}行为{}的后续状态为{}".format(s, a, successors))
+                next_s[s, i] = successors[0][0]
+                rewards[s, i] = get_reward(R, s, a)
+        absorbing = (next_s == np.asarray(S)[:, np.newaxis]).all(axis=1) & (rewards == 0).all(axis=1)
+        is_end[...] = absorbing[:, np.newaxis]
+    a_to_i = {a: i for i, a in enumerate(A)}
+    return a_to_i, next_s, rewards, is_end
+
+
 # 均一随机策略
 def uniform_random_pi(MDP=None, V=None, s=None, a=None):
     '''均一随机策略,只需要知道行为空间
@@ -67,11 +160,11 @@ def greedy_pi(MDP, V, s, a):
             考虑了多个状态具有相同最大值的情况， 此时贪婪策略从这多个具有相同最大值的行为中，随机选择一个
     '''
     S, A, P, R, gamma = MDP
+    _, next_s, _, _ = compile_dynamics(MDP)
     max_v, a_max_v = -float('inf'), []
 
     # 统计后续状态的最大价值以及到达该状态的行为(可能不止一个)
-    for a_opt in A:
-        s_prime, reward, _ = dynamics(s, a_opt)
+    for a_opt, s_prime in zip(A, next_s[s]):
         v_s_prime = get_value(V, s_prime)
         if v_s_prime > max_v:
             max_v = v_s_prime
@@ -118,11 +211,10 @@ def compute_q(MDP, V, s, a):
     '''根据给定的MDP,价值函数V, 计算状态行为对(s,a)的价值qsa
     '''
     S, A, R, P, gamma = MDP
-    q_sa = 0
-    for s_prime in S:
-        q_sa += get_prob(P, s, a, s_prime) * get_value(V, s_prime)
-
-    q_sa = get_reward(R, s, a) + gamma * q_sa
+    a_to_i, next_s, rewards, _ = compile_dynamics(MDP)
+    i = a_to_i[a]
+    # 确定性的环境， 只有一个后续状态的转移概率为1
+    q_sa = rewards[s, i] + gamma * get_value(V, next_s[s, i])
     return q_sa
 
 
@@ -136,30 +228,166 @@ def compute_v(MDP, V, Pi, s):
     return v_s
 
 
-def update_V(MDP, V, Pi):
-    '''给定一个MDP和一个策略， 更新该策略下的价值函数V
+def sweep_V(MDP, V, backup, synchronous=False):
+    '''对所有状态做一次备份， 并统计这次备份中最大的贝尔曼残差
+    Args:
+        backup 计算某状态新价值的函数 backup(MDP, V, s)
+        synchronous 为True时所有状态都使用备份前的价值计算(同步更新)，
+            否则直接在V上原地更新(Gauss-Seidel)
+    Returns:
+        tuple(V, delta) 更新后的状态价值以及最大残差
     '''
     S, _, _, _, _ = MDP
-    V_prime = V.copy()
+    V_prime = V.copy() if synchronous else V
+    delta = 0
     for s in S:
-        set_value(V_prime, s, compute_v(MDP, V_prime, Pi, s))
+        v = backup(MDP, V, s)
+        delta = max(delta, abs(v - get_value(V, s)))
+        set_value(V_prime, s, v)
+    return V_prime, delta
+
+
+# 使用profiler时统计调用次数的函数
+PROFILED = ["dynamics", "compute_q", "compute_v", "get_prob", "get_reward", "get_value", "get_pi"]
+
+
+def profiling(profiler):
+    '''在with语句内让profiler(utils.SolverProfiler)统计本模块函数的调用次数'''
+    return nullcontext() if profiler is None else profiler.attach(globals(), PROFILED)
+
+
+def iterate(MDP, V, backup, n, theta=None, synchronous=False,
+            return_residuals=False, profiler=None):
+    '''反复调用sweep_V， 最多n次， 最大残差小于theta时提前停止
+    return_residuals为True时同时返回每次迭代的最大残差
+    profiler不为None时记录调用次数以及每次迭代的耗时与残差
+    '''
+    V = V.copy()  # 只复制一次， 不修改传入的V
+    residuals = []
+    with profiling(profiler):
+        for i in range(n):
+            if profiler is not None:
+                profiler.start_sweep()
+            V, delta = sweep_V(MDP, V, backup, synchronous)
+            residuals.append(delta)
+            if profiler is not None:
+                profiler.end_sweep(delta, len(MDP[0]))
+            if theta is not None and delta < theta:
+                break
+    return (V, residuals) if return_residuals else V
+
+
+def update_V(MDP, V, Pi):
+    '''给定一个MDP和一个策略， 更新该策略下的价值函数V
+    '''
+    V_prime, _ = sweep_V(MDP, V.copy(), lambda MDP, V, s: compute_v(MDP, V, Pi, s))
     return V_prime
 
 
-def policy_evaluate(MDP, V, Pi, n):
+def policy_evaluate(MDP, V, Pi, n, theta=None, synchronous=False,
+                    return_residuals=False, profiler=None):
     '''策略评估: 使用n次迭代计算来评估一个MDP在给定策略Pi下的状态价值， 初始时， 价值为V
+    给定theta时， 最大残差小于theta即停止， n为最大迭代次数
     '''
-    for i in range(n):
-        V = update_V(MDP, V, Pi)
-    return V
+    return iterate(MDP, V, lambda MDP, V, s: compute_v(MDP, V, Pi, s), n,
+                   theta, synchronous, return_residuals, profiler)
 
 
-def policy_iterate(MDP, V, Pi, n, m):
+def policy_iterate(MDP, V, Pi, n, m, profiler=None):
     for i in range(m):
-        V = policy_evaluate(MDP, V, Pi, n)
+        V = policy_evaluate(MDP, V, Pi, n, profiler=profiler)
         Pi = greedy_pi  # 第一次迭代产生新的价值函数后，随机使用贪婪策略
     return V
 
+# 以表保存策略的策略迭代
+
+def evaluate_pi_table(MDP, V, pi, k=None):
+    '''评估以表保存的策略 pi (TabularPolicy或数组 shape(nS,nA))
+    Args:
+        V 初始状态价值， 只在k不为None时使用
+        k 为None时求解线性方程组 (I - gamma * P_pi) V = r_pi 得到精确的价值，
+          否则从V开始做k次同步迭代(修改的策略迭代)
+    Returns:
+        V 状态价值数组 shape(nS,)
+    Raises:
+        np.linalg.LinAlgError k为None而方程组没有唯一解， 比如gamma为1时策略在某些状态永远到达不了终止状态
+    '''
+    S, _, _, _, gamma = MDP
+    _, next_s, rewards, is_end = compile_dynamics(MDP)
+    pi = np.asarray(pi)
+    # 终止状态不再转移， 也没有奖励
+    live = ~is_end
+    r_pi = (pi * rewards * live).sum(axis=1)
+    if k is None:
+        P_pi = np.zeros((len(S), len(S)))
+        np.add.at(P_pi, (np.repeat(np.arange(len(S)), len(pi[0])), next_s.ravel()),
+                  (pi * live).ravel())
+        try:
+            return np.linalg.solve(np.eye(len(S)) - gamma * P_pi, r_pi)
+        except np.linalg.LinAlgError:
+            raise np.linalg.LinAlgError(
+                "策略的价值没有唯一解(gamma={}), 策略在某些状态无法到达终止状态, "
+                "可以给定k做k次迭代评估".format(gamma)) from None
+    V = np.array(V, dtype=float)
+    for i in range(k):
+        V = r_pi + gamma * (pi * live * V[next_s]).sum(axis=1)
+    return V
+
+
+def greedy_pi_table(MDP, V):
+    '''根据状态价值得到贪婪策略TabularPolicy， 多个行为的价值相同时平分概率
+    与greedy_pi给出的概率相同， 但只需对所有状态计算一次
+    '''
+    S, A, _, _, gamma = MDP
+    _, next_s, rewards, _ = compile_dynamics(MDP)
+    q = rewards + gamma * np.asarray(V, dtype=float)[next_s]
+    return TabularPolicy.greedy(S, A, q)
+
+
+def policy_iterate_table(MDP, V=None, pi=None, k=None, max_iter=100,
+                         return_iterations=False):
+    '''策略迭代: 评估当前策略表， 再取贪婪策略表， 策略不再变化时停止
+    Args:
+        V 初始状态价值， 为None时为0
+        pi 初始策略TabularPolicy， 为None时为均一随机策略
+        k 每次策略评估的迭代次数， 为None时精确评估， 见evaluate_pi_table
+        max_iter 最多改进策略的次数
+        return_iterations 是否同时返回改进策略的次数
+    Returns:
+        tuple(V, pi) 或 tuple(V, pi, iterations)
+    '''
+    S, A, _, _, _ = MDP
+    V = np.zeros(len(S)) if V is None else np.array(V, dtype=float)
+    if pi is None:
+        pi = TabularPolicy.uniform(S, A)
+    for i in range(max_iter):
+        V = evaluate_pi_table(MDP, V, pi, k)
+        new_pi = greedy_pi_table(MDP, V)
+        if new_pi == pi:  # 策略已经稳定
+            break
+        pi = new_pi
+    return (V, pi, i + 1) if return_iterations else (V, pi)
+
+
+def compile_mdp(MDP):
+    '''把方格世界编译为与MDP.compile_mdp相同格式的数组 (S, A, R[s,a], P[s,a,s'], gamma)
+    离开终止状态的转移概率与奖励都为0, 这样即使gamma为1, 线性方程组也有唯一解
+    '''
+    S, A, _, _, gamma = MDP
+    _, next_s, rewards, is_end = compile_dynamics(MDP)
+    live = ~is_end
+    P = np.zeros((len(S), len(A), len(S)))
+    P[np.arange(len(S))[:, np.newaxis], np.arange(len(A)), next_s] = live
+    return S, A, rewards * live, P, gamma
+
+
+def policy_evaluate_batch(MDP, pis, gammas=None, n=None, theta=None):
+    '''同时评估多个策略(TabularPolicy或数组 shape(nS,nA))与多个衰减因子
+    参数与返回值见MDP.policy_evaluate_batch
+    '''
+    return policy_evaluate_batch_tensor(compile_mdp(MDP), pis, gammas, n, theta)
+
+
 # 价值迭代得到最优状态价值过程
 
 
@@ -179,25 +407,83 @@ def compute_v_from_max_q(MDP, V, s):
 def update_V_without_pi(MDP, V):
     '''在不依赖策略的情况下，直接通过后续状态的价值来更新状态价值
     '''
+    V_prime, _ = sweep_V(MDP, V.copy(), compute_v_from_max_q)
+    return V_prime
+
+
+def value_iterate(MDP, V, n, theta=None, synchronous=False,
+                  return_residuals=False, profiler=None):
+    '''价值迭代， 参数同policy_evaluate'''
+    return iterate(MDP, V, compute_v_from_max_q, n, theta, synchronous,
+                   return_residuals, profiler)
+
+
+# 优先级扫描的异步价值迭代
+
+def predecessors(MDP):
+    '''根据编译好的动力学表建立前驱索引
+    Returns:
+        list preds[s1] 为能够一步转移到s1的状态列表
+    '''
     S, _, _, _, _ = MDP
-    V_prime = V.copy()
+    _, next_s, _, _ = compile_dynamics(MDP)
+    preds = [set() for _ in S]
     for s in S:
-        set_value(V_prime, s, compute_v_from_max_q(MDP, V_prime, s))
-    return V_prime
+        for s1 in next_s[s]:
+            preds[s1].add(s)
+    return [sorted(p) for p in preds]
 
 
-def value_iterate(MDP, V, n):
-    '''价值迭代'''
-    for i in range(n):
-        V = update_V_without_pi(MDP, V)
-    return V
+def prioritized_value_iterate(MDP, V, theta=1e-4, max_backups=None,
+                              return_backups=False, profiler=None):
+    '''优先级扫描: 按贝尔曼残差从大到小逐个备份状态， 不再对所有状态做完整的迭代
+    每备份一个状态后， 重新计算其前驱状态的残差， 大于theta的放入优先队列
+    Args:
+        V 初始状态价值
+        theta 残差阈值， 队列中没有残差大于theta的状态时停止
+        max_backups 最多备份的次数， 为None时不限制
+        return_backups 是否同时返回备份次数
+        profiler 统计调用次数与备份次数， 见iterate
+    Returns:
+        V 或 tuple(V, backups)
+    '''
+    S, _, _, _, _ = MDP
+    V = V.copy()
+    preds = predecessors(MDP)
+    priority = {}  # 状态在队列中的当前优先级(残差)
+    queue = []
+
+    def push(s):
+        error = abs(compute_v_from_max_q(MDP, V, s) - get_value(V, s))
+        if error > theta and error > priority.get(s, 0):
+            priority[s] = error
+            heapq.heappush(queue, (-error, s))
+
+    backups = 0
+    with profiling(profiler):
+        for s in S:
+            push(s)
+
+        while queue and (max_backups is None or backups < max_backups):
+            error, s = heapq.heappop(queue)
+            if priority.get(s) != -error:  # 该状态已经以更高的优先级处理过
+                continue
+            del priority[s]
+            set_value(V, s, compute_v_from_max_q(MDP, V, s))
+            backups += 1
+            for p in preds[s]:
+                push(p)
+    if profiler is not None:
+        profiler.count("backups", backups)
+    return (V, backups) if return_backups else V
+
 
 def greedy_policy(MDP,V,s):
     '''观察最优状态下对应的最优策略'''
     S,A,P,R,gamma = MDP
+    _, next_s, _, _ = compile_dynamics(MDP)
     max_v, a_max_v = -float('inf'),[]
-    for a_opt in A:
-        s_prime,reward,_ = dynamics(s,a_opt)
+    for a_opt, s_prime in zip(A, next_s[s]):
         v_s_prime = get_value(V,s_prime)
         if v_s_prime > max_v:
             max_v = v_s_prime
@@ -221,6 +507,11 @@ def main():
     V_pi = policy_evaluate(MDP, V, uniform_random_pi, 100)
     display_V(V_pi)
 
+    # 以数组保存的策略可以直接代替策略函数， 查询概率时只需按索引取值
+    V = [0 for _ in range(16)]  # 状态价值
+    V_pi = policy_evaluate(MDP, V, TabularPolicy.uniform(S, A), 100)
+    display_V(V_pi)
+
     V = [0 for _ in range(16)]  # 状态价值
     V_pi = policy_evaluate(MDP, V, greedy_pi, 100)
     display_V(V_pi)
@@ -230,13 +521,39 @@ def main():
     V_pi = policy_iterate(MDP, V, greedy_pi,1, 100)
     display_V(V_pi)
 
+    #以表保存策略的策略迭代, 精确评估策略， 策略稳定后停止
+    V_pi, pi, iterations = policy_iterate_table(MDP, return_iterations=True)
+    print("策略迭代{}次后策略稳定".format(iterations))
+    display_V(V_pi)
+
+    #保存模型与求解得到的价值、策略， 之后直接读取， 不必重新求解
+    path = os.path.join(tempfile.gettempdir(), "ch03_grid")
+    save_mdp(path, compile_mdp(MDP), V=V_pi, pi=pi.pi)
+    _, solved = load_mdp(path)
+    print("读取保存的价值与策略:", np.array_equal(solved["V"], V_pi), TabularPolicy(S, A, solved["pi"]) == pi)
+
+    #批量策略评估: 均一随机策略与最优策略在不同衰减因子下的价值
+    gammas = [0.5, 0.9, 1.0]
+    values = policy_evaluate_batch(MDP, [TabularPolicy.uniform(S, A), pi], gammas)
+    for name, v in zip(["均一随机策略", "最优策略"], values[:, :, 1]):
+        print(name, " ".join("gamma={}: {:.2f}".format(g, x) for g, x in zip(gammas, v)))
+
     #价值迭代
     V = [0 for _ in range(16)]  # 状态价值,重置
-    V_star = value_iterate(MDP, V,4)
+    V_star, residuals = value_iterate(MDP, V, 100, theta=1e-4,
+                                      return_residuals=True)
+    print("价值迭代{}次后收敛".format(len(residuals)))
     display_V(V_star)
 
 
     display_policy(greedy_policy,MDP,V_star)
+
+    #优先级扫描
+    V = [0 for _ in range(16)]  # 状态价值,重置
+    V_star, backups = prioritized_value_iterate(MDP, V, theta=1e-4,
+                                                return_backups=True)
+    print("优先级扫描共备份{}次".format(backups))
+    display_V(V_star)
     pass
 
 
@@ -1,11 +1,87 @@
-from random import shuffle
-from queue import Queue
+import json
+import os
+import random
+import string
+import time
+from multiprocessing import Pool
 from tqdm import tqdm  # 进度条
 import math
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.figure import Figure
 from mpl_toolkits.mplot3d import Axes3D
-from utils import str_key, set_dict, get_dict
+from utils import str_key, set_dict, get_dict, save_arrays, load_arrays
+
+
+# 牌以0-12的整数编码， 分别对应CARD_NAMES中的牌面， CARD_POINTS为其数值， A为1点
+CARD_NAMES = ['A', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K']
+CARD_POINTS = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10]
+# 牌面字符 -> 数值; 牌的编码直接以CARD_POINTS[card]取值， 两者分开， 整数不会被当作牌面
+VALUE_OF_FACE = dict(zip(CARD_NAMES, CARD_POINTS))
+
+
+def card_name(card):
+    '''牌的编码对应的牌面字符'''
+    return CARD_NAMES[card] if isinstance(card, int) else card
+
+
+# 对局信息的延迟格式化与统计
+
+class _TraceFormatter(string.Formatter):
+    """在str.format的基础上增加 {!c} 转换: 把牌的编码列表显示为牌面字符"""
+
+    def convert_field(self, value, conversion):
+        if conversion == 'c':
+            return [card_name(card) for card in value]
+        return super(_TraceFormatter, self).convert_field(value, conversion)
+
+
+_formatter = _TraceFormatter()
+
+
+def trace(display, fmt, *args):
+    '''display为True时才把参数格式化成消息并输出， 否则直接返回， 不构造任何字符串'''
+    if display:
+        print(_formatter.format(fmt, *args), end="")
+
+
+class ArenaStats():
+    """对局统计: 各种事件的次数与各阶段的耗时， 可以导出为字典或JSON用于监控"""
+
+    def __init__(self):
+        self.counters = {}  # 事件 -> 次数
+        self.timers = {}  # 阶段 -> 累计秒数
+        self.start_time = None  # 第一局开始的时间
+        self._last = None
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def start_lap(self):
+        '''开始计时， 之后每次调用lap记录距上一次的时间'''
+        self._last = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = self._last
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.timers[phase] = self.timers.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def export(self):
+        '''导出统计数据， 包括每秒对局数
+        elapsed 第一局开始至今的时间， playing 各阶段耗时之和(只计对局本身)， 每秒对局数以playing计算
+        '''
+        elapsed = 0.0 if self.start_time is None else time.perf_counter() - self.start_time
+        playing = sum(self.timers.values(), 0.0)
+        return {"counters": dict(self.counters),
+                "timers": dict(self.timers),
+                "elapsed": elapsed,
+                "playing": playing,
+                "hands_per_second": self.counters.get("hands", 0) / playing if playing > 0 else 0.0}
+
+    def to_json(self):
+        return json.dumps(self.export())
 
 
 class Gamer():
@@ -15,6 +91,8 @@ class Gamer():
 
         self.name = name  # 游戏者的姓名
         self.cards = []  # 手中的牌
+        self.hard_points = 0  # A计为1点时的总点数， 随发牌递增
+        self.has_ace = False  # 手中是否有A
         self.display = display  # 是否显示对局文字信息
         self.policy = None  # 策略
         self.learning_method = None  # 学习方法
@@ -28,68 +106,49 @@ class Gamer():
         Args:
                 card: 牌面信息 str
         Return:
-                牌的大小数值, int, A返回1
+                牌的大小数值, int, A返回1, 无法识别的牌返回0
         '''
-        try:
-            v = int(card)
-        except:
-            if card == 'A':
-                v = 1
-            elif card in ['J', 'Q', 'K']:
-                v = 10
-            else:
+        v = VALUE_OF_FACE.get(card) if type(card) is str else None
+        if v is None:
+            try:
+                v = int(card)
+            except (TypeError, ValueError):
                 v = 0
-        finally:
-            return v
+        return v
 
     def get_points(self):
         '''统计一手牌分值,如果使用了A的1点,同时返回True
-        Args:
-                cards 庄家或玩家手中的牌 list ['A','10','3']
+        总点数在receive时已经累加， 这里不需要再遍历手中的牌; 多张A中最多只有一张可以计为11点
         Return:
                 tuple (返回牌总点数， 是否使用了可复用Ace)
                 例如['A','10','3'] 返回 (14, False)
                         ['A','10']    返回 (21, True)
         '''
-        num_of_useable_ace = 0  # 默认没有拿到Ace
-        total_point = 0  # 总值
-        cards = self.cards
-        if cards is None:
-            return 0, False
-
-        # 考虑可能出现多张A的情况
-        for card in cards:
-            v = self._value_of(card)
-            if v == 1:  # 判断Ace,v变成11
-                num_of_useable_ace += 1
-                v = 11
-            total_point += v
-
-        # 如果： 总分值大于21, 而且拿到Ace
-        # 则： 总分值减去(num_of_useable_ace)个 A, 即 减10得到1
-        while total_point > 21 and num_of_useable_ace > 0:
-            total_point -= 10
-            num_of_useable_ace -= 1
-
-        return total_point, bool(num_of_useable_ace)
+        if self.has_ace and self.hard_points <= 11:
+            return self.hard_points + 10, True
+        return self.hard_points, False
 
     def receive(self, cards=[]):
         '''玩家获得一张或多张牌'''
-        cards = list(cards)
         for card in cards:
             self.cards.append(card)
+            # Shoe发出的是牌的编码(int 0-12)， 直接查表; 牌面字符由_value_of解析
+            v = CARD_POINTS[card] if type(card) is int else self._value_of(card)
+            self.hard_points += v
+            if v == 1:
+                self.has_ace = True
 
     def discharge_cards(self):
         '''玩家把手中的牌清空， 扔牌'''
         self.cards.clear()
+        self.hard_points, self.has_ace = 0, False
 
     def cards_info(self):
         '''玩家手中牌的信息'''
-        self._info("{}{}现在的牌:{}\n".format(self.role, self, self.cards))
+        self._info("{}{}现在的牌:{!c}\n", self.role, self, self.cards)
 
-    def _info(self, msg):
-        if self.display:
-            print(msg, end="")
+    def _info(self, fmt, *args):
+        trace(self.display, fmt, *args)
 
 
 class Dealer(Gamer):
@@ -105,7 +164,8 @@ class Dealer(Gamer):
         if self.cards is None or len(self.cards) == 0:
             return 0
 
-        return self._value_of(self.cards[0])
+        card = self.cards[0]
+        return CARD_POINTS[card] if type(card) is int else self._value_of(card)
 
     def dealer_policy(self, Dealer=None):
         '''庄家策略的细节'''
@@ -151,34 +211,71 @@ class Player(Gamer):
         return action
 
 
+class Shoe():
+    """由一副或多副牌组成的牌靴(发牌器)， 牌存放在一个list中， 发一张牌只需把下标加一"""
+
+    def __init__(self, num_decks=1, cut=0.75, seed=None):
+        '''
+        Args:
+                num_decks 牌的副数， 每副牌不包括大小王， 不区分花色
+                cut 切牌位置， 发出的牌超过这个比例后， 在下一局开始前重新洗牌
+                seed 随机种子， 每个牌靴使用自己的随机数生成器
+        '''
+        self.cards = list(range(13)) * 4 * num_decks  # 牌的编码
+        self.cut_point = int(len(self.cards) * cut)
+        self.rng = random.Random(seed)
+        self.pos = 0  # 下一张要发的牌
+        self.hand_start = 0  # 本局第一张牌的位置
+        self.reshuffles = 0  # 重新洗牌的次数， 不包括创建牌靴时的第一次洗牌
+        self.shuffle()
+
+    def shuffle(self):
+        '''所有的牌都已回收， 整个牌靴重新洗牌'''
+        self.rng.shuffle(self.cards)
+        self.pos, self.hand_start = 0, 0
+
+    def new_hand(self):
+        '''开始新的一局， 已经发过切牌位置时重新洗牌
+        Return:
+                是否重新洗了牌
+        '''
+        reshuffled = self.pos >= self.cut_point
+        if reshuffled:
+            self.shuffle()
+            self.reshuffles += 1
+        self.hand_start = self.pos
+        return reshuffled
+
+    def deal(self):
+        '''发出一张牌'''
+        if self.pos == len(self.cards):
+            self._reshuffle_discards()
+        card = self.cards[self.pos]
+        self.pos += 1
+        return card
+
+    def _reshuffle_discards(self):
+        '''一局还没有结束牌就发完了， 只把之前各局用过的牌洗一洗放到本局已发的牌之后'''
+        in_play, discards = self.cards[self.hand_start:], self.cards[:self.hand_start]
+        assert(len(discards) > 20)  # 确保一次能收集比较多的牌
+        self.rng.shuffle(discards)
+        self.cards = in_play + discards
+        self.pos, self.hand_start = len(in_play), 0
+        self.reshuffles += 1
+
+
 class Arena():
     """负责游戏管理"""
 
-    def __init__(self, display=None, A=None):
-        # 一副不包括大小王， 花色信息的牌
-        self.cards = ['A', '2', '3', '4', '5', '6',
-                      '7', '8', '9', '10', 'J', 'Q', 'K']*4
-        self.card_q = Queue(maxsize=52)  # 洗好的牌
-        self.cards_in_pool = []  # 已经用过的公开的牌
+    def __init__(self, display=None, A=None, num_decks=1, cut=0.75, seed=None,
+                 keep_episodes=True, stats=False):
+        self.shoe = Shoe(num_decks, cut, seed)  # 洗好的牌
+        self.stats = ArenaStats() if stats else None  # 对局统计， 为None时不统计
         self.display = display
         self.episodes = []  # 产生的对局信息列表
-        self.load_cards(self.cards)  # 把初始状态的52张牌装入发牌器
+        self.keep_episodes = keep_episodes  # 为False时不保存对局， 只交给play_games的consumer
         self.A = A  # 获取行为空间
 
-    def load_cards(self, cards):
-        '''把收集的牌洗一洗， 重新装到发牌器中
-        Args:
-                cards 要装入发牌器的多张牌 list
-        Return:
-                None
-        '''
-        shuffle(cards)  # 洗牌
-        for card in cards:  # deque数据结构只能一个一个添加
-            self.card_q.put(card)
-
-        cards.clear()  # 原来的牌清空
-        return
-
     def reward_of(self, dealer, player):
         '''判断玩家奖励值， 附带玩家，庄家的牌点信息'''
         dealer_points, _ = dealer.get_points()
@@ -197,44 +294,27 @@ class Arena():
         return reward, player_points, dealer_points, useable_ace
 
     def serve_card_to(self, player, n=1):
-        '''给庄家或玩家发牌， 如果牌不够则将公开牌池洗一洗，重新发牌
+        '''给庄家或玩家发牌， 如果牌不够牌靴会将用过的牌洗一洗，重新发牌
         Args:
                 player 一个庄家或玩家
                 n 一次连续发牌的数量
         Return:
                 None
         '''
-        cards = []  # 将要发出的牌
-        for _ in range(n):
-            # 要考虑发牌器没有牌的情况
-            if self.card_q.empty():
-                self._info("\n发牌器没牌了， 整理废牌， 重新洗牌;")
-                shuffle(self.cards_in_pool)
-                self._info("一共整理了{}张已用牌， 重新放入发牌器\n".format(
-                    len(self.cards_in_pool)))
-                assert(len(self.cards_in_pool) > 20)  # 确保一次能收集比较多的牌
-                self.load_cards(self.cards_in_pool)  # 将收集来的用过的牌，洗好送入发牌器，重新使用
-
-            # 从发牌器发出一张牌
-            cards.append(self.card_q.get())
-
-        self._info("发了{}张牌({})给{}{}:".format(n, cards, player.role, player))
+        cards = [self.shoe.deal() for _ in range(n)]  # 将要发出的牌
+        self._info("发了{}张牌({!c})给{}{}:", n, cards, player.role, player)
+        if self.stats is not None:
+            self.stats.count("cards_dealt", n)
         player.receive(cards)  # 庄家或玩家接受发出的牌
         player.cards_info()
 
-    def _info(self, message):
-        '''根据条件， 在终端输出对局信息'''
-        if self.display:
-            print(message, end="")
+    def _info(self, fmt, *args):
+        '''根据条件， 在终端输出对局信息， 不输出时不格式化消息'''
+        trace(self.display, fmt, *args)
 
     def recycle_cards(self, *players):
-        '''回收玩家手中的牌到公开使用过的牌池中'''
-        if len(players) == 0:
-            return
-
+        '''回收玩家手中的牌， 这些牌仍在牌靴中， 下一次洗牌时重新使用'''
         for player in players:
-            for card in player.cards:
-                self.cards_in_pool.append(card)
             player.discharge_cards()  # 玩家手中不再留有这些牌
 
     def play_game(self, dealer, player):
@@ -245,8 +325,15 @@ class Arena():
                 tuple: episode, reward
         '''
         self._info("======开始新一局======\n")
+        if self.stats is not None:
+            self.stats.count("hands")
+            self.stats.start_lap()
+        if self.shoe.new_hand():
+            self._info("已经发到切牌位置， 重新洗牌\n")
         self.serve_card_to(player, n=2)  # 发两张牌给玩家
         self.serve_card_to(dealer, n=2)  # 发两张牌给庄家
+        if self.stats is not None:
+            self.stats.lap("deal")
         episode = []  # 记录一个对局信息
         if player.policy is None:
             self._info("玩家需要一个策略")
@@ -258,7 +345,7 @@ class Arena():
         while True:
             action = player.policy(dealer)
             # 玩家的策略产生一个行为
-            self._info("{}{}选择：{};".format(player.role, player, action))
+            self._info("{}{}选择：{};", player.role, player, action)
             episode.append(
                 (player.get_state_name(dealer), action))  # 记录一个(s,a)
 
@@ -267,24 +354,30 @@ class Arena():
             else:  # 停止叫牌
                 break
 
+        if self.stats is not None:
+            self.stats.lap("player")
         # 玩家停止叫牌后,要计算玩家手中的点数， 玩家如果爆了， 庄家就不继续了
         reward, player_points, dealer_points, useable_ace = self.reward_of(
             dealer, player)
 
         if player_points > 21:  # 玩家爆了
-            self._info("玩家爆点{}输了， 得分:{}\n".format(player_points, reward))
+            self._info("玩家爆点{}输了， 得分:{}\n", player_points, reward)
             self.recycle_cards(player, dealer)  # 回收牌
             # 预测的时候， 需要形成episode list后集中学习V
-            self.episodes.append((episode, reward))
+            if self.keep_episodes:
+                self.episodes.append((episode, reward))
             # 在蒙特卡罗控制的时候， 可以不需要episodes list，生成一个episode学习一个， 下同
             self._info("==========本局结束=======\n")
+            if self.stats is not None:
+                self.stats.count("player_busts")
+                self.stats.lap("settle")
             return episode, reward
 
         # 玩家并没有超过21点
         self._info("\n")
         while True:
             action = dealer.policy()  # 庄家从其策略中获取一个行为
-            self._info("{}{}选择:{};".format(dealer.role, dealer, action))
+            self._info("{}{}选择:{};", dealer.role, dealer, action)
             # 状态只记录庄家第一张牌信息， 此时玩家不再叫牌，(s,a)不必重复记录
             if action == self.A[0]:  # 庄家"继续叫牌"
                 self.serve_card_to(dealer)
@@ -292,6 +385,8 @@ class Arena():
                 break
 
         # 双方均停止叫牌了
+        if self.stats is not None:
+            self.stats.lap("dealer")
         self._info("\n双方均停止叫牌;\n")
         reward, player_points, dealer_points, useable_ace = self.reward_of(
             dealer, player)
@@ -304,30 +399,631 @@ class Arena():
         else:
             self._info("双方和局！")
 
-        self._info("玩家{}点,庄家{}点\n".format(player_points, dealer_points))
+        self._info("玩家{}点,庄家{}点\n", player_points, dealer_points)
         self._info("========本局结束=======\n")
         self.recycle_cards(player, dealer)  # 回收玩家和庄家手中的牌至公开牌池
         # 将刚才产生的完整结局添加值状态序列列表 ,蒙特卡罗控制不需要
-        self.episodes.append((episode, reward))
+        if self.keep_episodes:
+            self.episodes.append((episode, reward))
+        if self.stats is not None:
+            self.stats.lap("settle")
         return episode, reward
 
-    def play_games(self, dealer, player, num=2, show_statistic=True):
-        '''一次性玩多局游戏'''
+    def play_games(self, dealer, player, num=2, show_statistic=True, show_progress=True,
+                   consumer=None):
+        '''一次性玩多局游戏, 返回玩家负，和， 胜局数
+        consumer(episode, reward) 每一局结束后都会被调用， 例如EpisodeLog.append，
+        与keep_episodes=False一起使用时对局不会在内存中堆积
+        '''
         results = [0, 0, 0]  # 玩家负，和， 胜局数
         self.episodes.clear()
-       	for i in tqdm(range(num)):
+        for i in tqdm(range(num), disable=not show_progress):
             episode, reward = self.play_game(dealer, player)
             results[1+reward] += 1
             if player.learning_method is not None:
                 player.learning_method(episode, reward)
+            if consumer is not None:
+                consumer(episode, reward)
 
         if show_statistic:
             print("共玩了{}局，玩家赢{}局,和{}局,输{}局,胜率：{:.2f}, 不输率:{:.2f}"
                   .format(num, results[2], results[1], results[0], results[2]/num, (results[1]+results[2]) / num))
+        return results
+
+    def export_stats(self):
+        '''导出对局统计(需要以stats=True创建Arena)'''
+        if self.stats is None:
+            return None
+        stats = self.stats.export()
+        stats["counters"]["reshuffles"] = self.shoe.reshuffles
+        return stats
+
+
+# 多进程生成对局
+
+def _play_games_worker(args):
+    '''子进程: 用独立的随机种子玩num局， 只返回各状态的收获之和与访问次数， 不返回对局本身'''
+    num, seed, A = args
+    # 每个进程独立、可复现的洗牌顺序
+    player, dealer = Player(A=A), Dealer(A=A)
+    arena = Arena(A=A, seed=seed, keep_episodes=False)
+    G, Ns = {}, {}  # 收获之和， 访问次数
+
+    def accumulate(episode, r):
+        for s, a in episode:
+            set_dict(G, get_dict(G, s) + r, s)
+            set_dict(Ns, get_dict(Ns, s) + 1, s)
+
+    results = arena.play_games(dealer, player, num=num, show_statistic=False,
+                               show_progress=False, consumer=accumulate)
+    return G, Ns, results
+
+
+def play_games_parallel(num, A, V, Ns, workers=4, seed=None, show_statistic=True):
+    '''把num局分给多个进程同时生成， 每个进程使用自己的Arena和独立的随机种子，
+    汇总各进程的收获之和与访问次数后合并到V, Ns中， 与在一个进程中调用policy_evaluate等价
+    Args:
+        num 总对局数
+        A 行为空间
+        V, Ns 状态价值和访问次数， 可以已经含有之前的统计数据
+        workers 进程数
+        seed 随机种子， 相同的seed与workers得到相同的结果
+    Returns:
+        list 玩家负，和， 胜局数
+    '''
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    tasks = [(num // workers + (i < num % workers), int(s.generate_state(1)[0]), A)
+             for i, s in enumerate(seeds)]
+    with Pool(workers) as pool:
+        partials = pool.map(_play_games_worker, tasks)
+
+    results = [0, 0, 0]
+    G_total, N_total = {}, {}
+    for G, N, worker_results in partials:
+        results = [x + y for x, y in zip(results, worker_results)]
+        for s, g in G.items():
+            G_total[s] = G_total.get(s, 0) + g
+            N_total[s] = N_total.get(s, 0) + N[s]
+
+    # 与递增式更新等价: V = (V*ns + G) / (ns + n)
+    for s, g in G_total.items():
+        ns, v, n = get_dict(Ns, s), get_dict(V, s), N_total[s]
+        set_dict(Ns, ns + n, s)
+        set_dict(V, (v * ns + g) / (ns + n), s)
+
+    if show_statistic:
+        print("共玩了{}局，玩家赢{}局,和{}局,输{}局,胜率：{:.2f}, 不输率:{:.2f}"
+              .format(num, results[2], results[1], results[0], results[2]/num, (results[1]+results[2]) / num))
+    return results
+
+
+# 以numpy数组批量模拟对局
+
+CARD_VALUES = np.array(CARD_POINTS)
+# 状态数组的形状: 庄家明牌(1-10), 玩家总点数(0-31, 21点时叫牌最多到31点), 是否有可用的A
+STATE_SHAPE = (11, 32, 2)
+
+
+def hand_points(hard_points, has_ace):
+    '''由A计为1点时的总点数和是否拿到A， 得到(总点数, 是否使用了可复用Ace)， 与get_points一致'''
+    useable_ace = has_ace & (hard_points + 10 <= 21)
+    return hard_points + 10 * useable_ace, useable_ace
+
+
+def naive_policy_table():
+    '''与Player.naive_policy相同的表格策略: 点数小于20继续叫牌
+    Return:
+        继续叫牌的概率 shape STATE_SHAPE
+    '''
+    table = np.zeros(STATE_SHAPE)
+    table[:, :20, :] = 1.0
+    return table
 
-    def _info(self, message):
-        if self.display:
-            print(message, end="")
+
+def state_names():
+    '''每个状态对应的状态名， 与Player.get_state_name一致， shape STATE_SHAPE'''
+    names = np.empty(STATE_SHAPE, dtype=object)
+    for index in np.ndindex(*STATE_SHAPE):
+        d, p, ace = index
+        names[index] = str_key(d, p, bool(ace))
+    return names
+
+
+class EpisodeBatch():
+    """以数组存储的一批对局, 第i局的第t步为(dealer[i], points[i,t], ace[i,t]), actions[i,t]"""
+
+    def __init__(self, dealer, points, ace, actions, lengths, rewards, probs=None):
+        self.dealer = dealer  # 庄家第一张牌的值 shape(N,)
+        self.points = points  # 玩家每一步的总点数 shape(N,T)
+        self.ace = ace  # 玩家每一步是否有可用的A shape(N,T)
+        self.actions = actions  # 玩家每一步的行为, 0继续叫牌 1停止叫牌 shape(N,T)
+        self.lengths = lengths  # 每一局的步数 shape(N,)
+        self.rewards = rewards  # 每一局的奖励 shape(N,)
+        self.probs = probs  # 行为策略选择该行为的概率 shape(N,T)， 未记录时为None
+
+    def __len__(self):
+        return len(self.rewards)
+
+    def mask(self):
+        '''有效步的掩码 shape(N,T)'''
+        return np.arange(self.points.shape[1]) < self.lengths[:, None]
+
+    def to_episodes(self, A):
+        '''转换为与Arena.episodes相同格式的 [(episode, reward), ...]'''
+        names = state_names()
+        step_names = names[self.dealer[:, None], self.points, self.ace.astype(int)]
+        episodes = []
+        for i, n in enumerate(self.lengths):
+            episode = [(step_names[i, t], A[self.actions[i, t]]) for t in range(n)]
+            episodes.append((episode, int(self.rewards[i])))
+        return episodes
+
+
+class BatchArena():
+    """用numpy数组同步模拟成批的对局， 规则与Arena, naive_policy, dealer_policy, reward_of相同
+    与Arena不同的是， 每张牌都独立地从13种牌面中等概率抽取(相当于无限副牌)，
+    玩家爆点后直接停止叫牌"""
+
+    def __init__(self, A=None, seed=None):
+        self.A = A  # 行为空间
+        self.rng = np.random.default_rng(seed)
+        self.episodes = []  # 与Arena格式相同的对局信息列表
+
+    def deal(self, n):
+        '''发出n张牌， 返回牌的数值'''
+        return CARD_VALUES[self.rng.integers(0, 13, size=n)]
+
+    def play_batch(self, num, policy=None):
+        '''同时玩num局
+        Args:
+            num 对局数
+            policy 表格策略， 各状态下继续叫牌的概率 shape STATE_SHAPE， 默认为naive_policy_table
+        Returns:
+            EpisodeBatch
+        '''
+        if policy is None:
+            policy = naive_policy_table()
+        # 玩家和庄家各发两张牌
+        player_cards, dealer_cards = self.deal((2, num)), self.deal((2, num))
+        player_hard = player_cards.sum(axis=0)
+        player_has_ace = (player_cards == 1).any(axis=0)
+        dealer_first = dealer_cards[0]
+        dealer_hard = dealer_cards.sum(axis=0)
+        dealer_has_ace = (dealer_cards == 1).any(axis=0)
+
+        points_steps, ace_steps, action_steps, prob_steps = [], [], [], []
+        lengths = np.zeros(num, dtype=int)
+        active = np.ones(num, dtype=bool)
+        while active.any():
+            points, useable_ace = hand_points(player_hard, player_has_ace)
+            hit_prob = policy[dealer_first, points, useable_ace.astype(int)]
+            hit = active & (self.rng.random(num) < hit_prob) & (points <= 21)
+            points_steps.append(points)
+            ace_steps.append(useable_ace)
+            action_steps.append(np.where(hit, 0, 1))
+            # 记录行为策略选择该行为的概率， 爆点后的停止叫牌是确定的
+            prob_steps.append(np.where(points > 21, 1.0, np.where(hit, hit_prob, 1 - hit_prob)))
+            lengths += active
+            # 继续叫牌的玩家各发一张牌
+            cards = self.deal(num)
+            player_hard = player_hard + np.where(hit, cards, 0)
+            player_has_ace = player_has_ace | (hit & (cards == 1))
+            active = hit
+
+        player_points, _ = hand_points(player_hard, player_has_ace)
+        # 玩家没有爆点时庄家按dealer_policy叫牌
+        dealer_points, _ = hand_points(dealer_hard, dealer_has_ace)
+        active = (player_points <= 21) & (dealer_points < 17)
+        while active.any():
+            cards = self.deal(num)
+            dealer_hard = dealer_hard + np.where(active, cards, 0)
+            dealer_has_ace = dealer_has_ace | (active & (cards == 1))
+            dealer_points, _ = hand_points(dealer_hard, dealer_has_ace)
+            active = active & (dealer_points < 17)
+
+        rewards = np.where(player_points > 21, -1,
+                           np.where((player_points > dealer_points) | (dealer_points > 21), 1,
+                                    np.where(player_points == dealer_points, 0, -1)))
+        return EpisodeBatch(dealer_first, np.stack(points_steps, axis=1),
+                            np.stack(ace_steps, axis=1), np.stack(action_steps, axis=1),
+                            lengths, rewards, np.stack(prob_steps, axis=1))
+
+    def play_games(self, num=2, policy=None, batch_size=10000, show_statistic=True,
+                   keep_episodes=True):
+        '''分批玩num局， keep_episodes为True时同时把对局转换为Arena的格式保存在self.episodes中
+        Returns:
+            list of EpisodeBatch
+        '''
+        batches = []
+        self.episodes.clear()
+        for start in range(0, num, batch_size):
+            batch = self.play_batch(min(batch_size, num - start), policy)
+            batches.append(batch)
+            if keep_episodes:
+                self.episodes.extend(batch.to_episodes(self.A))
+
+        if show_statistic:
+            rewards = np.concatenate([batch.rewards for batch in batches])
+            results = [np.sum(rewards == r) for r in (-1, 0, 1)]
+            print("共玩了{}局，玩家赢{}局,和{}局,输{}局,胜率：{:.2f}, 不输率:{:.2f}"
+                  .format(num, results[2], results[1], results[0], results[2]/num, (results[1]+results[2]) / num))
+        return batches
+
+
+# 整数编码的二进制对局日志
+
+# 日志中每一步的记录: 对局编号， 庄家明牌， 玩家点数， 是否有可用的A， 行为索引， 该局的奖励
+STEP_DTYPE = np.dtype([('episode', '<u4'), ('dealer', 'u1'), ('points', 'u1'),
+                       ('ace', 'u1'), ('action', 'u1'), ('reward', 'i1')])
+
+
+class EpisodeLog():
+    """把对局以STEP_DTYPE记录追加写入二进制文件， 文件可以用load_steps内存映射后直接学习"""
+
+    def __init__(self, path, A, append=False, buffer_size=65536):
+        '''
+        Args:
+                path 日志文件路径
+                A 行为空间， 行为按其在A中的索引存储
+                append 为True时在已有的日志后继续写入， 对局编号接着已有的编号
+        '''
+        self.path = path
+        self.a_to_i = {a: i for i, a in enumerate(A)}
+        self.num_episodes = 0
+        if append:
+            steps = load_steps(path) if os.path.exists(path) else []
+            if len(steps) > 0:
+                self.num_episodes = int(steps['episode'][-1]) + 1
+        self.file = open(path, 'ab' if append else 'wb')
+        self.buffer = np.zeros(buffer_size, dtype=STEP_DTYPE)
+        self.n = 0  # 缓冲区中的记录数
+        self._states = {}  # 状态名 -> (庄家明牌, 玩家点数, 是否有可用的A)
+
+    def _state_of(self, name):
+        state = self._states.get(name)
+        if state is None:
+            dealer, points, ace = name.split('_')
+            state = self._states[name] = (int(dealer), int(points), ace == 'True')
+        return state
+
+    def append(self, episode, reward):
+        '''追加一局Arena格式的对局， 可以直接作为Arena.play_games的consumer'''
+        if self.n + len(episode) > len(self.buffer):
+            self.flush()
+        for s, a in episode:
+            dealer, points, ace = self._state_of(s)
+            self.buffer[self.n] = (self.num_episodes, dealer, points, ace,
+                                   self.a_to_i[a], reward)
+            self.n += 1
+        self.num_episodes += 1
+
+    def append_batch(self, batch):
+        '''追加一个EpisodeBatch'''
+        self.flush()
+        mask = batch.mask()
+        steps = np.zeros(int(mask.sum()), dtype=STEP_DTYPE)
+        episode_ids = np.broadcast_to(np.arange(len(batch))[:, None], mask.shape)
+        steps['episode'] = self.num_episodes + episode_ids[mask]
+        steps['dealer'] = np.broadcast_to(batch.dealer[:, None], mask.shape)[mask]
+        steps['points'] = batch.points[mask]
+        steps['ace'] = batch.ace[mask]
+        steps['action'] = batch.actions[mask]
+        steps['reward'] = np.broadcast_to(batch.rewards[:, None], mask.shape)[mask]
+        steps.tofile(self.file)
+        self.num_episodes += len(batch)
+
+    def flush(self):
+        self.buffer[:self.n].tofile(self.file)
+        self.n = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_steps(path, mmap=True):
+    '''读取对局日志， mmap为True时内存映射文件而不读入内存'''
+    if mmap:
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=STEP_DTYPE)
+        return np.memmap(path, dtype=STEP_DTYPE, mode='r')
+    return np.fromfile(path, dtype=STEP_DTYPE)
+
+
+def steps_to_batch(steps):
+    '''把按对局顺序排列的日志记录转换为EpisodeBatch'''
+    episode_ids = np.asarray(steps['episode'])
+    if len(episode_ids) == 0:
+        starts = np.zeros(0, dtype=int)
+    else:
+        starts = np.flatnonzero(np.r_[True, episode_ids[1:] != episode_ids[:-1]])
+    lengths = np.diff(np.r_[starts, len(steps)])
+    rows = np.repeat(np.arange(len(starts)), lengths)
+    cols = np.arange(len(steps)) - np.repeat(starts, lengths)
+    shape = (len(starts), lengths.max(initial=0))
+    points = np.zeros(shape, dtype=int)
+    ace = np.zeros(shape, dtype=bool)
+    actions = np.ones(shape, dtype=int)
+    points[rows, cols] = steps['points']
+    ace[rows, cols] = steps['ace']
+    actions[rows, cols] = steps['action']
+    return EpisodeBatch(np.asarray(steps['dealer'][starts], dtype=int), points, ace, actions,
+                        lengths, np.asarray(steps['reward'][starts], dtype=int))
+
+
+def read_batches(path, chunk_steps=1000000):
+    '''分块读取对局日志， 每块在对局边界处切开， 比chunk_steps更长的对局单独成为一块
+    日志中的对局编号是递增的(见EpisodeLog)， 用二分查找定位对局的边界
+    Yields:
+        EpisodeBatch
+    '''
+    steps = load_steps(path)
+    episode_ids = steps['episode']
+    start = 0
+    while start < len(steps):
+        end = min(start + chunk_steps, len(steps))
+        if end < len(steps) and episode_ids[end] == episode_ids[end - 1]:
+            # 块的末尾在一局的中间: 把这一局留到下一块， 这一局从块的开头开始时则把整局放在这一块
+            first = int(np.searchsorted(episode_ids, episode_ids[end], side='left'))
+            end = first if first > start else \
+                int(np.searchsorted(episode_ids, episode_ids[end], side='right'))
+        yield steps_to_batch(steps[start:end])
+        start = end
+
+
+# 以数组存储的状态价值
+
+class ValueTable():
+    """以数组存储的状态价值与访问次数， 形状为STATE_SHAPE(庄家明牌, 玩家点数, 是否有可用的A)
+    保存每个状态收获之和G与访问次数N， V=G/N, 与policy_evaluate的每次访问递增式更新等价，
+    两张表可以直接相加合并"""
+
+    def __init__(self):
+        self.G = np.zeros(STATE_SHAPE)  # 收获之和
+        self.N = np.zeros(STATE_SHAPE, dtype=np.int64)  # 访问次数
+        self._index = {}  # 状态名 -> 数组中的扁平索引
+
+    @property
+    def V(self):
+        '''状态价值数组， 没有访问过的状态价值为0'''
+        return np.divide(self.G, self.N, out=np.zeros(STATE_SHAPE), where=self.N > 0)
+
+    def index_of(self, state_name):
+        '''状态名对应的扁平索引'''
+        i = self._index.get(state_name)
+        if i is None:
+            dealer, points, ace = state_name.split('_')
+            i = self._index[state_name] = np.ravel_multi_index(
+                (int(dealer), int(points), int(ace == 'True')), STATE_SHAPE)
+        return i
+
+    def add_episode(self, episode, reward):
+        '''学习一局Arena格式的对局， 可以作为Arena.play_games的consumer'''
+        G, N = self.G.reshape(-1), self.N.reshape(-1)
+        for s, a in episode:
+            i = self.index_of(s)
+            G[i] += reward
+            N[i] += 1
+
+    def update(self, episodes):
+        '''学习Arena格式的对局列表'''
+        for episode, reward in episodes:
+            self.add_episode(episode, reward)
+
+    def update_batch(self, batch):
+        '''一次学习一个EpisodeBatch， 用bincount把所有步的收获累加到对应状态上'''
+        mask = batch.mask()
+        dealer = np.broadcast_to(batch.dealer[:, None], mask.shape)
+        index = np.ravel_multi_index(
+            (dealer[mask], batch.points[mask], batch.ace[mask].astype(int)), STATE_SHAPE)
+        rewards = np.broadcast_to(batch.rewards[:, None], mask.shape)[mask]
+        size = self.N.size
+        self.G += np.bincount(index, weights=rewards, minlength=size).reshape(STATE_SHAPE)
+        self.N += np.bincount(index, minlength=size).reshape(STATE_SHAPE)
+
+    def merge(self, other):
+        '''合并另一张表的统计数据'''
+        self.G += other.G
+        self.N += other.N
+
+    def as_dict(self, counts=False):
+        '''以状态名为键的字典， 可以用于draw_value
+        Args:
+            counts 为True时返回访问次数， 否则返回状态价值
+        '''
+        table = self.N if counts else self.V
+        names = state_names()
+        return {names[index]: table[index].item() for index in zip(*np.nonzero(self.N))}
+
+    def save(self, path):
+        '''保存收获之和与访问次数， 读取后可以继续学习或合并'''
+        save_arrays(path, {"G": self.G, "N": self.N}, {"type": "ValueTable"})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, _ = load_arrays(path, mmap)
+        table = cls()
+        table.G, table.N = arrays["G"], arrays["N"]
+        return table
+
+
+# 同策略蒙特卡罗控制
+
+class MCControlPlayer(Player):
+    """使用ε-贪婪策略的同策略蒙特卡罗控制玩家
+    行为价值Q与访问次数N以数组存储， 形状为STATE_SHAPE + (行为数,)，
+    通过learning_method在每一局结束后学习， 也可以配合BatchArena成批学习"""
+
+    def __init__(self, name="", A=None, display=False, epsilon=1.0, epsilon_decay=0.99999,
+                 epsilon_min=0.01, seed=None):
+        super(MCControlPlayer, self).__init__(name, A, display)
+        self.Q = np.zeros(STATE_SHAPE + (len(A),))  # 行为价值
+        self.N = np.zeros(STATE_SHAPE + (len(A),), dtype=np.int64)  # 访问次数
+        self.epsilon = epsilon  # 探索的概率
+        self.epsilon_decay = epsilon_decay  # 每学习一局， epsilon乘以该系数
+        self.epsilon_min = epsilon_min
+        self.rng = np.random.default_rng(seed)
+        self.visits = []  # 本局中经过的(状态, 行为)索引
+        self.policy = self.epsilon_greedy_policy
+        self.learning_method = self.learn_Q
+
+    def epsilon_greedy_policy(self, dealer):
+        '''以epsilon的概率随机选择行为， 否则选择Q最大的行为， 爆点后直接停止叫牌'''
+        dealer_card, points, useable_ace = self.get_state(dealer)
+        if points > 21:
+            return self.A[1]
+        state = (dealer_card, points, int(useable_ace))
+        if self.rng.random() < self.epsilon:
+            action = int(self.rng.integers(len(self.A)))
+        else:
+            action = int(np.argmax(self.Q[state]))
+        self.visits.append(state + (action,))
+        return self.A[action]
+
+    def learn_Q(self, episode, reward):
+        '''每次访问的递增式蒙特卡罗更新， 使用policy记录的索引而不是episode中的状态名'''
+        for index in self.visits:
+            self.N[index] += 1
+            self.Q[index] += (reward - self.Q[index]) / self.N[index]
+        self.visits.clear()
+        self.epsilon = max(self.epsilon_min, self.epsilon * self.epsilon_decay)
+
+    def policy_table(self, epsilon=None):
+        '''当前ε-贪婪策略的表格形式(继续叫牌的概率)， 供BatchArena使用'''
+        epsilon = self.epsilon if epsilon is None else epsilon
+        greedy_hit = np.argmax(self.Q, axis=-1) == 0
+        return (1 - epsilon) * greedy_hit + epsilon / len(self.A)
+
+    def learn_batch(self, batch):
+        '''成批学习一个EpisodeBatch， 等价于逐局调用learn_Q(只是epsilon在整批之后才衰减)
+        爆点后的强制停止叫牌不是策略的选择， 与epsilon_greedy_policy相同， 不记入Q与N
+        '''
+        mask = batch.mask() & (batch.points <= 21)
+        dealer = np.broadcast_to(batch.dealer[:, None], mask.shape)
+        index = np.ravel_multi_index(
+            (dealer[mask], batch.points[mask], batch.ace[mask].astype(int),
+             batch.actions[mask]), self.Q.shape)
+        rewards = np.broadcast_to(batch.rewards[:, None], mask.shape)[mask]
+        G = np.bincount(index, weights=rewards, minlength=self.Q.size).reshape(self.Q.shape)
+        n = np.bincount(index, minlength=self.Q.size).reshape(self.Q.shape)
+        self.N += n
+        visited = n > 0
+        self.Q[visited] += (G[visited] - n[visited] * self.Q[visited]) / self.N[visited]
+        self.epsilon = max(self.epsilon_min, self.epsilon * self.epsilon_decay ** len(batch))
+
+    def train(self, arena, num, batch_size=10000, snapshots=None):
+        '''用BatchArena成批生成num局对局并学习， 给定snapshots(ValueSnapshots)时按间隔记录max_a Q'''
+        for start in tqdm(range(0, num, batch_size)):
+            batch = arena.play_batch(min(batch_size, num - start), self.policy_table())
+            self.learn_batch(batch)
+            if snapshots is not None:
+                snapshots.step(self.Q, len(batch))
+
+    def q_dict(self):
+        '''以"状态名_行为"为键的行为价值字典， 可以用于draw_value(is_q_dict=True)'''
+        names = state_names()
+        return {names[index[:3]] + '_' + str(self.A[index[3]]): self.Q[index].item()
+                for index in zip(*np.nonzero(self.N))}
+
+    def save_q(self, path):
+        '''保存行为价值、访问次数与当前的epsilon'''
+        save_arrays(path, {"Q": self.Q, "N": self.N},
+                    {"type": "MCControlPlayer", "A": self.A, "epsilon": self.epsilon})
+
+    def load_q(self, path, mmap=True):
+        '''读取save_q保存的行为价值， 行为空间需要相同'''
+        arrays, meta = load_arrays(path, mmap)
+        if meta["A"] != list(self.A):
+            raise ValueError("保存的行为空间{}与当前的行为空间{}不同".format(meta["A"], self.A))
+        self.Q, self.N = arrays["Q"], arrays["N"]
+        self.epsilon = meta["epsilon"]
+
+
+# 异策略蒙特卡罗评估与控制
+
+def action_probs(policy, batch):
+    '''表格策略policy(继续叫牌的概率)选择batch中各步行为的概率 shape(N,T)，
+    爆点后的停止叫牌以及补齐的部分概率为1
+    '''
+    points = np.minimum(batch.points, STATE_SHAPE[1] - 1)
+    hit_prob = policy[batch.dealer[:, None], points, batch.ace.astype(int)]
+    probs = np.where(batch.actions == 0, hit_prob, 1 - hit_prob)
+    return np.where((batch.points > 21) | ~batch.mask(), 1.0, probs)
+
+
+def importance_sampling(batches, target, behavior=None, weighted=True):
+    '''用行为策略产生的对局估计目标策略target下的V和Q(每次访问, 衰减因子为1)
+    从第t步开始的重要性采样比率为 W_t = prod_{k>=t} target(a_k|s_k) / behavior(a_k|s_k)
+        普通重要性采样  V(s) = sum(W_t * G) / n(s)
+        加权重要性采样  V(s) = sum(W_t * G) / sum(W_t)
+    Q(s_t,a_t)使用 W_t+1， 因为a_t已经给定
+    Args:
+        batches 一个或多个EpisodeBatch
+        target 目标策略， 继续叫牌的概率 shape STATE_SHAPE
+        behavior 行为策略， 为None时使用batch中记录的概率(BatchArena.play_batch记录了概率，
+                 从对局日志读取的batch没有， 此时必须给出behavior)
+        weighted 是否使用加权重要性采样
+    Returns:
+        tuple(V, Q), shape STATE_SHAPE 与 STATE_SHAPE + (2,)， 没有样本的位置为0
+    '''
+    if isinstance(batches, EpisodeBatch):
+        batches = [batches]
+    q_shape = STATE_SHAPE + (2,)
+    v_num, v_den = np.zeros(np.prod(STATE_SHAPE)), np.zeros(np.prod(STATE_SHAPE))
+    q_num, q_den = np.zeros(np.prod(q_shape)), np.zeros(np.prod(q_shape))
+    for batch in batches:
+        mask = batch.mask()
+        if behavior is not None:
+            b = action_probs(behavior, batch)
+        elif batch.probs is None:
+            raise ValueError("batch中没有记录行为的概率(比如从对局日志读取的batch)， 需要给出behavior")
+        else:
+            b = np.where(mask, batch.probs, 1.0)
+        rho = action_probs(target, batch) / b
+        # 从每一步到本局结束的比率之积， 倒序累乘
+        W = np.cumprod(rho[:, ::-1], axis=1)[:, ::-1]
+        W_next = np.concatenate([W[:, 1:], np.ones((len(batch), 1))], axis=1)
+        dealer = np.broadcast_to(batch.dealer[:, None], mask.shape)[mask]
+        G = np.broadcast_to(batch.rewards[:, None], mask.shape)[mask]
+        state = (dealer, batch.points[mask], batch.ace[mask].astype(int))
+        v_index = np.ravel_multi_index(state, STATE_SHAPE)
+        q_index = np.ravel_multi_index(state + (batch.actions[mask],), q_shape)
+        for index, w, num, den in ((v_index, W[mask], v_num, v_den),
+                                   (q_index, W_next[mask], q_num, q_den)):
+            num += np.bincount(index, weights=w * G, minlength=len(num))
+            den += np.bincount(index, weights=w if weighted else None, minlength=len(den))
+    V = np.divide(v_num, v_den, out=np.zeros_like(v_num), where=v_den > 0)
+    Q = np.divide(q_num, q_den, out=np.zeros_like(q_num), where=q_den > 0)
+    return V.reshape(STATE_SHAPE), Q.reshape(q_shape)
+
+
+def greedy_table(Q):
+    '''由行为价值得到确定性的贪婪策略(继续叫牌的概率为0或1)'''
+    return (np.argmax(Q, axis=-1) == 0).astype(float)
+
+
+def off_policy_control(batches, behavior=None, max_iter=50):
+    '''异策略蒙特卡罗控制: 反复用加权重要性采样估计贪婪策略的Q， 再取新的贪婪策略，
+    直到策略不再变化， 所有迭代都复用同一批行为策略产生的对局
+    Returns:
+        tuple(target, Q) 最终的贪婪策略与其行为价值
+    '''
+    _, Q = importance_sampling(batches, np.full(STATE_SHAPE, 0.5), behavior)
+    target = greedy_table(Q)
+    for i in range(max_iter):
+        _, Q = importance_sampling(batches, target, behavior)
+        new_target = greedy_table(Q)
+        if np.array_equal(new_target, target):
+            break
+        target = new_target
+    return target, Q
 
 
 def policy_evaluate(episodes, V, Ns):
@@ -343,39 +1039,163 @@ def policy_evaluate(episodes, V, Ns):
     pass
 
 
-def draw_value(value_dict, useable_ace=True, is_q_dict=False, A=None):
+class ValueSnapshots():
+    """学习过程中每隔every局记录一次状态价值， 保存在预先分配的环形缓冲区中，
+    缓冲区满后覆盖最早的快照， 记录时直接写入缓冲区， 不复制字典"""
+
+    def __init__(self, capacity=100, every=10000):
+        self.V = np.zeros((capacity,) + STATE_SHAPE)  # 快照
+        self.episodes = np.zeros(capacity, dtype=np.int64)  # 记录快照时已学习的局数
+        self.every = every
+        self.count = 0  # 已记录的快照总数
+        self.num_episodes = 0  # 已学习的局数
+        self._next = every  # 下一次记录快照的局数
+
+    def take(self, values, num_episodes):
+        '''记录一次快照
+        Args:
+            values ValueTable， 状态价值数组 shape STATE_SHAPE，
+                   或行为价值数组 shape STATE_SHAPE + (nA,)(取最大值)
+            num_episodes 已学习的局数
+        '''
+        i = self.count % len(self.V)
+        if isinstance(values, ValueTable):
+            self.V[i].fill(0)
+            np.divide(values.G, values.N, out=self.V[i], where=values.N > 0)
+        elif np.ndim(values) == len(STATE_SHAPE) + 1:
+            np.max(values, axis=-1, out=self.V[i])
+        else:
+            np.copyto(self.V[i], values)
+        self.episodes[i] = num_episodes
+        self.count += 1
+
+    def step(self, values, n=1):
+        '''又学习了n局， 到了记录的间隔时记录快照'''
+        self.num_episodes += n
+        if self.num_episodes >= self._next:
+            self.take(values, self.num_episodes)
+            self._next = (self.num_episodes // self.every + 1) * self.every
+
+    def tracker(self, values):
+        '''返回一个可以作为Arena.play_games的consumer的函数， 学习每一局并按间隔记录快照'''
+        def consumer(episode, reward):
+            values.add_episode(episode, reward)
+            self.step(values)
+        return consumer
+
+    def history(self):
+        '''按时间顺序返回缓冲区中的快照
+        Returns:
+            tuple(episodes, V) shape(n,) 与 shape(n,) + STATE_SHAPE
+        '''
+        n = min(self.count, len(self.V))
+        order = (np.arange(n) + self.count - n) % len(self.V)
+        return self.episodes[order], self.V[order]
+
+    def convergence(self):
+        '''各快照与前一快照之间价值的最大变化， 以及与最后一个快照的平均差距'''
+        episodes, V = self.history()
+        if len(V) == 0:  # 还没有记录快照， 比如学习的局数不足every
+            return episodes, np.zeros(0), np.zeros(0)
+        flat = V.reshape(len(V), -1)
+        max_change = np.abs(np.diff(flat, axis=0)).max(axis=1, initial=0)
+        mean_gap = np.abs(flat - flat[-1:]).mean(axis=1)
+        return episodes, max_change, mean_gap
+
+
+def value_surface(values, useable_ace=True):
+    '''一次从数组中取出绘图用的高度 shape(10,10)， 行为玩家总分数12-21， 列为庄家第一张牌1-10
+    Args:
+        values ValueTable， 状态价值数组 shape STATE_SHAPE，
+               或行为价值数组 shape STATE_SHAPE + (nA,)(取最大值)
+    '''
+    V = values.V if isinstance(values, ValueTable) else np.asarray(values)
+    if V.ndim == len(STATE_SHAPE) + 1:
+        V = V.max(axis=-1)
+    return V[1:11, 12:22, int(useable_ace)].T
+
+
+def _new_figure(filename):
+    '''需要保存为文件时直接创建Figure, 不经过pyplot， 在没有显示器的服务器上也可以绘图'''
+    return plt.figure() if filename is None else Figure()
+
+
+def _show_or_save(fig, filename):
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename)
+
+
+def draw_value(value_dict, useable_ace=True, is_q_dict=False, A=None, filename=None):
+    '''绘制状态价值曲面
+    Args:
+        value_dict 以状态名为键的价值字典， 或ValueTable、价值数组(见value_surface)
+        filename 为None时显示图形， 否则保存到该文件
+    '''
         # 定义figure
-    fig = plt.figure()
+    fig = _new_figure(filename)
     # 将figure变为3d
-    ax = Axes3D(fig)
+    ax = fig.add_subplot(projection='3d')
     # 定义x,y
     x = np.arange(1, 11, 1)  # 庄家第一张牌
     y = np.arange(12, 22, 1)  # 玩家总分数
     # 生成网格数据
     X, Y = np.meshgrid(x, y)
-    # 从V字典检索Z轴的高度
-    row, col = X.shape
-    Z = np.zeros((row, col))
-    if is_q_dict:
-        n = len(A)
-
-    for i in range(row):
-        for j in range(col):
-            state_name = str(X[i, j]) + '_' + \
-                str(Y[i, j]) + '_'+str(useable_ace)
-            if not is_q_dict:
-                Z[i, j] = get_dict(value_dict, state_name)
-            else:
-                assert(A is not None)
-                for a in A:
-                    new_state_name = state_name+'_'+str(a)
-                    q = get_dict(value_dict, new_state_name)
-                    if q >= Z[i, j]:
-                        Z[i, j] = q
+    if isinstance(value_dict, (ValueTable, np.ndarray)):
+        Z = value_surface(value_dict, useable_ace)
+    else:
+        # 从V字典检索Z轴的高度
+        row, col = X.shape
+        Z = np.zeros((row, col))
+        for i in range(row):
+            for j in range(col):
+                state_name = str(X[i, j]) + '_' + \
+                    str(Y[i, j]) + '_'+str(useable_ace)
+                if not is_q_dict:
+                    Z[i, j] = get_dict(value_dict, state_name)
+                else:
+                    assert(A is not None)
+                    for a in A:
+                        new_state_name = state_name+'_'+str(a)
+                        q = get_dict(value_dict, new_state_name)
+                        if q >= Z[i, j]:
+                            Z[i, j] = q
 
     # 绘制3D曲面
     ax.plot_surface(X, Y, Z, rstride=1, cstride=1, color="lightgray")
-    plt.show()
+    _show_or_save(fig, filename)
+
+
+def draw_convergence(snapshots, filename=None):
+    '''绘制价值的收敛曲线: 相邻快照间的最大变化， 以及与最后一个快照的平均差距'''
+    episodes, max_change, mean_gap = snapshots.convergence()
+    fig = _new_figure(filename)
+    ax = fig.add_subplot()
+    ax.plot(episodes[1:], max_change, label="max |V_k - V_k-1|")
+    ax.plot(episodes, mean_gap, label="mean |V_k - V_last|")
+    ax.set_xlabel("episodes")
+    ax.legend()
+    _show_or_save(fig, filename)
+
+
+def render_snapshots(snapshots, directory, prefix="value"):
+    '''把缓冲区中每个快照的价值曲面(有/无可用的A)以及收敛曲线保存为图片
+    Returns:
+        list 保存的文件路径
+    '''
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for episodes, V in zip(*snapshots.history()):
+        for useable_ace in (True, False):
+            path = os.path.join(directory, "{}_{}_{}.png".format(
+                prefix, episodes, "ace" if useable_ace else "no_ace"))
+            draw_value(V, useable_ace, filename=path)
+            paths.append(path)
+    path = os.path.join(directory, "{}_convergence.png".format(prefix))
+    draw_convergence(snapshots, filename=path)
+    paths.append(path)
+    return paths
 
 
 def main():
@@ -390,9 +1210,9 @@ def main():
     # 生成num个完整的对局
     arena.play_games(dealer, player, num=200000)
     # 策略评估
-    V = {}  # 状态价值字典
-    Ns = {}  # 状态被访问的次数节点
-    policy_evaluate(arena.episodes, V, Ns)  # 学习V值
+    values = ValueTable()  # 以数组存储的状态价值和访问次数
+    values.update(arena.episodes)  # 学习V值
+    V = values.as_dict()  # 状态价值字典
 
     draw_value(V, useable_ace=True, A=A)  # 绘制有可用的A时状态价值图
     draw_value(V, useable_ace=False, A=A)  # 绘制无可用的A时状态价值图
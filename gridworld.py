@@ -0,0 +1,248 @@
+# 可配置的方格世界: 任意宽高、障碍物、终止状态与滑动概率
+# 策略评估与价值迭代以整个价值数组的平移切片(模板运算)完成， 不再逐个状态调用dynamics
+
+import time
+import numpy as np
+
+A = ["n", "e", "s", "w"]  # 行为空间, 与ch03.py相同
+
+
+def _cells(cells, shape):
+    '''把 (行,列) 的列表或布尔数组统一转换为布尔数组 shape(height, width)'''
+    mask = np.zeros(shape, dtype=bool)
+    if cells is None:
+        return mask
+    cells = np.asarray(cells)
+    if cells.dtype == bool:
+        mask[...] = cells
+    elif cells.size > 0:
+        rows, cols = cells.reshape(-1, 2).T
+        mask[rows, cols] = True
+    return mask
+
+
+def shift(X, a, out, fill=None):
+    '''把数组X按行为a平移: out[r,c] 为在(r,c)执行行为a到达的格子在X中的值
+    Args:
+        X 数组 shape(height, width)
+        a 行为的索引， 0-3 分别表示 北, 东, 南, 西
+        out 结果数组 shape(height, width)
+        fill 超出边界时使用的值， 为None时使用X在原地的值(撞墙后停在原地)
+    '''
+    if a == 0:
+        out[1:] = X[:-1]
+        out[0] = X[0] if fill is None else fill
+    elif a == 1:
+        out[:, :-1] = X[:, 1:]
+        out[:, -1] = X[:, -1] if fill is None else fill
+    elif a == 2:
+        out[:-1] = X[1:]
+        out[-1] = X[-1] if fill is None else fill
+    else:
+        out[:, 1:] = X[:, :-1]
+        out[:, 0] = X[:, 0] if fill is None else fill
+    return out
+
+
+class GridWorld():
+    '''方格世界, 状态为格子(行,列), 展开后的状态索引为 行 * width + 列
+    离开非终止格子时获得奖励reward, 终止格子与障碍物的价值始终为0,
+    撞到边界或障碍物时停在原地; slip不为0时， 以slip的概率平均滑向其他三个方向之一
+    默认设置(左上角与右下角为终止状态， 奖励-1, gamma为1)与ch03.py中的4x4方格世界相同
+    '''
+
+    def __init__(self, width, height, obstacles=None, terminals=None, slip=0.0,
+                 reward=-1.0, gamma=1.0):
+        '''
+        Args:
+            width, height 方格世界的宽和高
+            obstacles 障碍物， (行,列)的列表或布尔数组 shape(height, width)
+            terminals 终止状态， 格式同obstacles， 为None时为左上角与右下角
+            slip 滑向其他方向的概率
+            reward 离开格子时获得的奖励， 标量或数组 shape(height, width)
+            gamma 衰减因子
+        '''
+        self.width, self.height = width, height
+        self.shape = (height, width)
+        if terminals is None:
+            terminals = [(0, 0), (height - 1, width - 1)]
+        self.obstacles = _cells(obstacles, self.shape)
+        self.terminals = _cells(terminals, self.shape) & ~self.obstacles
+        self.slip = slip
+        self.gamma = gamma
+        self.fixed = self.obstacles | self.terminals  # 价值始终为0的格子
+        self._fixed_rows, self._fixed_cols = np.nonzero(self.fixed)
+        self.reward = np.where(self.fixed, 0.0, np.broadcast_to(reward, self.shape))
+        # blocked[a] 在该格子执行行为a会撞到障碍物
+        self.blocked = np.zeros((len(A),) + self.shape, dtype=bool)
+        for a in range(len(A)):
+            shift(self.obstacles, a, self.blocked[a], fill=False)
+        self._has_obstacles = self.obstacles.any()
+        self._buffer = None
+
+    @property
+    def num_states(self):
+        return self.width * self.height
+
+    def successor_values(self, V):
+        '''所有格子执行每个行为后(不考虑滑动)到达格子的价值 shape(4, height, width)
+        返回的数组会在下一次调用时被复用
+        '''
+        if self._buffer is None or self._buffer.dtype != V.dtype:
+            self._buffer = np.empty((len(A),) + self.shape, dtype=V.dtype)
+        out = self._buffer
+        for a in range(len(A)):
+            shift(V, a, out[a])
+        if self._has_obstacles:
+            np.copyto(out, V, where=self.blocked)
+        return out
+
+    def expected_successor_values(self, V):
+        '''考虑滑动概率后， 执行每个行为得到的后续状态价值的期望 shape(4, height, width)'''
+        Vn = self.successor_values(V)
+        if self.slip:
+            others = self.slip / (len(A) - 1)
+            total = Vn.sum(axis=0)
+            Vn *= 1 - self.slip - others
+            Vn += others * total
+        return Vn
+
+    def q_values(self, V):
+        '''行为价值 q[a, r, c]'''
+        q = self.expected_successor_values(V)
+        q *= self.gamma
+        q += self.reward
+        q[:, self._fixed_rows, self._fixed_cols] = 0
+        return q
+
+    def _finish(self, v):
+        '''由后续状态价值的期望v得到新的状态价值 reward + gamma * v, 终止格子与障碍物为0'''
+        if self.gamma != 1:
+            v *= self.gamma
+        v += self.reward
+        v[self._fixed_rows, self._fixed_cols] = 0
+        return v
+
+    def _backup_max(self, V):
+        # 各方向滑动概率相同， 选择行为只改变哪个方向的概率为 1 - slip， 因此
+        # max_a q[a] = r + gamma * (c1 * max_a Vn[a] + c2 * sum_a Vn[a]), 不需要计算完整的q
+        c2 = self.slip / (len(A) - 1)
+        c1 = 1 - self.slip - c2
+        if c1 < 0:
+            return self.q_values(V).max(axis=0)
+        Vn = self.successor_values(V)
+        v = np.maximum.reduce(Vn)
+        if self.slip:
+            v *= c1
+            v += c2 * Vn.sum(axis=0)
+        return self._finish(v)
+
+    def _iterate(self, backup, V, n, theta, return_residuals):
+        V = np.zeros(self.shape) if V is None else np.array(V, dtype=float).reshape(self.shape)
+        diff = np.empty(self.shape)
+        residuals = []
+        for i in range(n):
+            V_prime = backup(V)
+            np.subtract(V_prime, V, out=diff)
+            residuals.append(float(np.abs(diff, out=diff).max(initial=0)))
+            V = V_prime
+            if theta is not None and residuals[-1] < theta:
+                break
+        return (V, residuals) if return_residuals else V
+
+    def policy_evaluate(self, pi=None, V=None, n=1000, theta=1e-4, return_residuals=False):
+        '''策略评估， 每次迭代同步更新所有格子
+        Args:
+            pi 策略数组 shape(height, width, 4) 或 shape(num_states, 4)(比如TabularPolicy),
+               为None时为均一随机策略
+            V 初始价值 shape(height, width)， 为None时全部为0
+            n 最大迭代次数
+            theta 最大残差小于theta时停止， 为None时迭代n次
+            return_residuals 是否同时返回每次迭代的最大残差
+        Returns:
+            V 价值数组 shape(height, width) 或 tuple(V, residuals)
+        '''
+        if pi is not None:
+            pi = np.moveaxis(np.asarray(pi, dtype=float).reshape(self.shape + (len(A),)), -1, 0)
+
+        def backup(V):
+            Vn = self.expected_successor_values(V)
+            if pi is None:
+                v = Vn.sum(axis=0)
+                v /= len(A)
+            else:
+                v = np.einsum('arc,arc->rc', pi, Vn)
+            return self._finish(v)
+        return self._iterate(backup, V, n, theta, return_residuals)
+
+    def value_iterate(self, V=None, n=1000, theta=1e-4, return_residuals=False):
+        '''价值迭代， 每次迭代同步更新所有格子， 参数与返回值见policy_evaluate'''
+        return self._iterate(self._backup_max, V, n, theta, return_residuals)
+
+    def greedy_policy(self, V, atol=1e-8):
+        '''根据状态价值得到贪婪策略 shape(height, width, 4)， 多个行为的价值相差不超过atol时平分概率'''
+        q = self.q_values(np.asarray(V, dtype=float).reshape(self.shape))
+        best = np.isclose(q, q.max(axis=0), rtol=0, atol=atol)
+        return np.moveaxis(best / best.sum(axis=0), 0, -1)
+
+    def successors(self):
+        '''稀疏的后续状态形式 (succ, prob, R, gamma), 见parallel.to_successors
+        succ[s, a, k] 为执行行为a后滑向第k个方向到达的状态， 没有滑动时每个行为只有一个后续状态
+        '''
+        n = self.num_states
+        index = np.arange(n, dtype=float).reshape(self.shape)
+        target = self.successor_values(index).reshape(len(A), n).T.astype(np.int32)  # shape(n, 4)
+        live = ~self.fixed.ravel()
+        R = np.repeat(self.reward.reshape(n, 1), len(A), axis=1)
+        if not self.slip:
+            return target[:, :, np.newaxis], live[:, np.newaxis, np.newaxis] * np.ones((1, len(A), 1)), \
+                R, self.gamma
+        succ = np.repeat(target[:, np.newaxis], len(A), axis=1)
+        others = self.slip / (len(A) - 1)
+        prob = np.full((len(A), len(A)), others)
+        np.fill_diagonal(prob, 1 - self.slip)
+        return succ, live[:, np.newaxis, np.newaxis] * prob, R, self.gamma
+
+    def compile_mdp(self):
+        '''编译为与MDP.compile_mdp相同格式的 (S, A, R[s,a], P[s,a,s'], gamma)
+        P为稠密数组， 只适合较小的方格世界
+        '''
+        succ, prob, R, gamma = self.successors()
+        n = self.num_states
+        P = np.zeros((n, len(A), n))
+        s, a, _ = np.indices(succ.shape)
+        np.add.at(P, (s, a, succ), prob)
+        return list(range(n)), list(A), R, P, gamma
+
+    def display(self, V, fmt='{0:>6.2f}'):
+        '''显示状态价值， 障碍物显示为#'''
+        V = np.asarray(V).reshape(self.shape)
+        for r in range(self.height):
+            print(" ".join('{0:>6}'.format("#") if self.obstacles[r, c] else fmt.format(V[r, c])
+                           for c in range(self.width)))
+        print()
+
+
+def main():
+    # 与ch03.py相同的4x4方格世界
+    grid = GridWorld(4, 4)
+    grid.display(grid.policy_evaluate(theta=1e-6))
+    V_star, residuals = grid.value_iterate(return_residuals=True)
+    print("价值迭代{}次后收敛".format(len(residuals)))
+    grid.display(V_star)
+
+    # 带障碍物与滑动的方格世界
+    grid = GridWorld(10, 6, obstacles=[(1, 3), (2, 3), (3, 3), (4, 6), (3, 6)],
+                     terminals=[(5, 9)], slip=0.1, gamma=0.95)
+    grid.display(grid.value_iterate(), fmt='{0:>6.1f}')
+
+    # 大型方格世界
+    grid = GridWorld(1000, 1000, gamma=0.9)
+    start = time.perf_counter()
+    V_star, residuals = grid.value_iterate(theta=1e-3, return_residuals=True)
+    print("1000x1000方格世界价值迭代{}次， 耗时{:.2f}秒".format(
+        len(residuals), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# 多进程价值迭代: 状态按块分给多个子进程， 模型与状态价值放在共享内存中， 不在进程间复制
+#
+# 模型使用稀疏的后续状态形式 (succ, prob, R):
+#   succ[s, a, k] 第k个可能的后续状态, prob[s, a, k] 对应的转移概率, R[s, a] 奖励
+# 可以由to_successors从compile_mdp编译得到的MDP转换， 或者由GridWorld.successors得到
+
+import os
+import time
+from multiprocessing import Barrier, Process, RawArray
+from multiprocessing.shared_memory import SharedMemory
+from threading import BrokenBarrierError, Event, Thread
+
+import numpy as np
+
+import MDP
+from gridworld import GridWorld
+
+MODES = ("jacobi", "async")
+
+
+def to_successors(cMDP):
+    '''把稠密的MDP (S, A, R[s,a], P[s,a,s'], gamma) 转换为稀疏的后续状态形式
+    Returns:
+        tuple(succ, prob, R, gamma), 每个状态行为对的后续状态数K为所有状态行为对中的最大值,
+        不足K个的部分概率为0
+    '''
+    S, _, R, P, gamma = cMDP
+    nonzero = P > 0
+    K = max(int(nonzero.sum(axis=2).max(initial=0)), 1)
+    succ = np.argsort(~nonzero, axis=2, kind="stable")[..., :K]
+    prob = np.take_along_axis(P, succ, axis=2)
+    return succ.astype(np.int32), prob, np.asarray(R, dtype=float), gamma
+
+
+def backup_block(succ, prob, R, gamma, V, lo, hi):
+    '''状态lo到hi-1的贝尔曼最优备份 max_a (R[s,a] + gamma * sum_k prob[s,a,k] * V[succ[s,a,k]])'''
+    q = R[lo:hi] + gamma * (prob[lo:hi] * V[succ[lo:hi]]).sum(axis=2)
+    return q.max(axis=1)
+
+
+def _attach(specs):
+    '''按 (名称, 形状, 类型) 连接到共享内存， 返回共享内存对象与对应的数组'''
+    blocks = [SharedMemory(name=name) for name, _, _ in specs]
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+              for shm, (_, shape, dtype) in zip(blocks, specs)]
+    return blocks, arrays
+
+
+def _sweeps(succ, prob, R, Vs, gamma, lo, hi, chunk_size, mode, index, barrier, control,
+            residuals):
+    '''子进程的主循环: 每次迭代更新状态lo到hi-1， 把该块的最大残差写入residuals[index]
+    control[0] 不为0时退出， control[1] 为本次迭代读取的价值数组
+    '''
+    while True:
+        barrier.wait()  # 等待主进程开始一次迭代
+        if control[0]:
+            return
+        src = Vs[int(control[1])]
+        # 同步(jacobi)时写入另一个价值数组; 异步时在原地更新， 后面的块立即使用新的价值
+        dst = src if mode == "async" else Vs[1 - int(control[1])]
+        residual = 0.0
+        for start in range(lo, hi, chunk_size):
+            stop = min(start + chunk_size, hi)
+            v = backup_block(succ, prob, R, gamma, src, start, stop)
+            residual = max(residual, float(np.abs(v - src[start:stop]).max(initial=0)))
+            dst[start:stop] = v
+        residuals[index] = residual
+        barrier.wait()  # 本次迭代完成
+
+
+def _worker(specs, *args):
+    barrier = args[-3]
+    blocks, arrays = [], []
+    try:
+        blocks, arrays = _attach(specs)
+        _sweeps(*arrays, *args)
+    except BaseException:
+        barrier.abort()  # 让主进程和其他子进程不再等待
+        raise
+    finally:
+        del arrays  # 关闭共享内存前先释放引用它的数组
+        for shm in blocks:
+            shm.close()
+
+
+def _watch(processes, barrier, done, interval=0.1):
+    '''主进程中的监视线程: 子进程在迭代结束前退出(比如被系统杀死)时中止barrier, 避免主进程一直等待'''
+    while not done.wait(interval):
+        if any(p.exitcode is not None for p in processes):
+            barrier.abort()
+            return
+
+
+def value_iterate_parallel(succ, prob, R, gamma, V=None, n=1000, theta=1e-4, workers=None,
+                           mode="jacobi", chunk_size=65536, return_residuals=False):
+    '''多进程价值迭代， 收敛条件与MDP.value_iterate_tensor相同: 一次迭代中所有状态价值的
+    最大变化小于theta时停止
+    Args:
+        succ, prob, R, gamma 稀疏的后续状态形式的MDP， 见to_successors
+        V 初始价值数组 shape(nS,)， 为None时全部为0
+        n 最大迭代次数
+        theta 为None时迭代n次
+        workers 子进程数， 默认为CPU核数
+        mode "jacobi" 每次迭代只使用上一次迭代的价值， 结果与value_iterate_tensor相同;
+             "async" 各进程在共享的价值数组上原地更新自己的块， 不等待其他进程的新值
+        chunk_size 每次向量化计算的状态数， 决定临时数组的大小
+        return_residuals 是否同时返回每次迭代的最大残差
+    Returns:
+        V 价值数组 shape(nS,) 或 tuple(V, residuals)
+    '''
+    if mode not in MODES:
+        raise ValueError("mode只能是{}之一".format(MODES))
+    nS = len(R)
+    workers = min(workers or os.cpu_count() or 1, nS)
+    arrays = [np.ascontiguousarray(succ), np.ascontiguousarray(prob, dtype=float),
+              np.ascontiguousarray(R, dtype=float), np.zeros((2, nS))]
+    if V is not None:
+        arrays[3][0] = V
+    blocks = [SharedMemory(create=True, size=max(x.nbytes, 1)) for x in arrays]
+    processes, Vs = [], None
+    try:
+        specs = []
+        for shm, x in zip(blocks, arrays):
+            np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+            specs.append((shm.name, x.shape, x.dtype))
+        Vs = np.ndarray((2, nS), dtype=float, buffer=blocks[3].buf)
+
+        barrier = Barrier(workers + 1)
+        control = RawArray('d', 2)  # 是否退出, 本次迭代读取的价值数组
+        residuals = RawArray('d', workers)
+        bounds = np.linspace(0, nS, workers + 1).astype(int)
+        for i in range(workers):
+            p = Process(target=_worker, args=(specs, gamma, bounds[i], bounds[i + 1], chunk_size,
+                                              mode, i, barrier, control, residuals), daemon=True)
+            p.start()
+            processes.append(p)
+
+        done = Event()
+        watcher = Thread(target=_watch, args=(processes, barrier, done), daemon=True)
+        watcher.start()
+        history = []
+        try:
+            for i in range(n):
+                barrier.wait()
+                barrier.wait()
+                history.append(max(residuals))
+                if mode == "jacobi":
+                    control[1] = 1 - control[1]
+                if theta is not None and history[-1] < theta:
+                    break
+            done.set()  # 之后子进程会正常退出
+            control[0] = 1
+            barrier.wait()
+        except BrokenBarrierError:
+            raise RuntimeError("价值迭代的子进程异常退出") from None
+        finally:
+            done.set()
+            watcher.join()
+        V = Vs[int(control[1])].copy()
+    finally:
+        Vs = None
+        for p in processes:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return (V, history) if return_residuals else V
+
+
+def main():
+    cMDP = MDP.compile_mdp(MDP.MDP)
+    V = value_iterate_parallel(*to_successors(cMDP), n=100, workers=2)
+    print("学生MDP的最优价值:", np.round(V, 2))
+    print("与value_iterate_tensor的最大差值:",
+          np.abs(V - MDP.value_iterate_tensor(cMDP, None, 100, theta=1e-4)).max())
+
+    grid = GridWorld(500, 500, slip=0.1, gamma=0.9)
+    for mode in MODES:
+        start = time.perf_counter()
+        V, residuals = value_iterate_parallel(*grid.successors(), mode=mode,
+                                              theta=1e-3, return_residuals=True)
+        print("500x500方格世界 {}: 迭代{}次， 耗时{:.2f}秒".format(
+            mode, len(residuals), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,11 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
 def str_key(*args):
 	'''将参数用"-"连接起来作为字典的键， 需注意参数本身可能会是tuple或者list型
 	比如类似（（a,b,c）,d）
@@ -11,29 +19,185 @@ def str_key(*args):
 	return "_".join(new_arg)
 
 
+def _atom(x):
+	'''单个参数在str_key中对应的部分: str原样使用， tuple或list与str_key相同地展开连接， 其他类型取str'''
+	if type(x) in [tuple, list]:
+		return "_".join([str(i) for i in x])
+	return str(x)
+
+
+class KeyTable():
+	'''以整数索引存储的键值表， 可以替代以str_key为键的字典
+	参数的每一个位置(比如状态s, 行为a, 后续状态s1)分别把出现过的参数登记为小整数，
+	值存放在按 (i_s, i_a, i_s1) 排列的稠密数组(扁平的list)中， 查询只需几次字典查找与一次下标运算，
+	参数从未出现过或者该位置没有设置过值时直接返回默认值， 不调用str_key也不抛出异常。
+	每个参数按它在str_key中的写法比较， 因此相等但str_key不同的参数(比如 1, 1.0 与 True)是不同的键;
+	与str_key字典不同的是参数按位置比较， ("a_b", "c") 与 ("a", "b_c") 是不同的键。
+	同一个表中的键需要有相同的参数个数
+	'''
+	INITIAL_SIZE = 8  # 每个位置初始可以登记的参数个数， 不够时加倍
+
+
+	def __init__(self, default=0):
+		self._atoms = []  # 每个位置一个字典: 参数的str_key写法 -> 小整数
+		self._sizes = []  # 每个位置的容量， 稠密数组的形状
+		self.values = []  # 稠密数组， 按 (i_s, i_a, i_s1) 展开
+		self._present = bytearray()  # 稠密数组中的每一项是否设置过值
+		self._entries = []  # 设置过的键， 每个键为各位置的小整数组成的元组
+		self._keys = []  # 设置过的键的str_key， 与_entries对应
+		self._by_key = {}  # str_key -> 在_entries中的位置
+		self.default = default
+		self.counters = None  # 不为None时在这个字典中统计str_key的调用次数， 见SolverProfiler.count_keys
+
+	def _offset(self, ids):
+		'''各位置的小整数在稠密数组中的下标'''
+		i = 0
+		for size, j in zip(self._sizes, ids):
+			i = i * size + j
+		return i
+
+	def _grow(self, position):
+		'''加倍某一位置的容量， 把已设置的值搬到新的下标'''
+		old = [(self._offset(ids), ids) for ids in self._entries]
+		self._sizes[position] *= 2
+		total = 1
+		for size in self._sizes:
+			total *= size
+		values = [self.default] * total
+		present = bytearray(total)
+		for i, ids in old:
+			j = self._offset(ids)
+			values[j] = self.values[i]
+			present[j] = 1
+		self.values, self._present = values, present
+
+	def index(self, *args, create=True):
+		'''返回参数对应的值在稠密数组中的下标， 参数没有设置过值时登记该键(create为False时返回None)'''
+		if not self._atoms:
+			if not create:
+				return None
+			self._atoms = [{} for _ in args]
+			self._sizes = [self.INITIAL_SIZE] * len(args)
+			self.values = [self.default] * self.INITIAL_SIZE ** len(args)
+			self._present = bytearray(len(self.values))
+		if len(args) != len(self._atoms):
+			if not create:
+				return None
+			raise ValueError("KeyTable中的键需要有相同的参数个数: {}, 而不是{}".format(
+				len(self._atoms), len(args)))
+		ids = []
+		for position, (atoms, x) in enumerate(zip(self._atoms, args)):
+			j = atoms.get(x if type(x) is str else _atom(x))
+			if j is None:
+				if not create:
+					return None
+				j = atoms[x if type(x) is str else _atom(x)] = len(atoms)
+				if j == self._sizes[position]:
+					self._grow(position)
+			ids.append(j)
+		i = self._offset(ids)
+		if not self._present[i]:
+			if not create:
+				return None
+			if self.counters is not None:
+				self.counters["str_key"] = self.counters.get("str_key", 0) + 1
+			key = str_key(*args)
+			self._by_key[key] = len(self._entries)
+			self._entries.append(tuple(ids))
+			self._keys.append(key)
+			self._present[i] = 1
+		return i
+
+	def set(self, value, *args):
+		i = self.index(*args)  # 可能扩容， 之后再取稠密数组
+		self.values[i] = value
+
+	def get(self, *args):
+		# 1至3个参数(价值、策略与奖励、状态转移概率)时直接按参数本身查找， 不经过循环
+		atoms = self._atoms
+		try:
+			if len(args) == 3 == len(atoms):
+				i, j, k = atoms[0].get(args[0]), atoms[1].get(args[1]), atoms[2].get(args[2])
+				if i is not None and j is not None and k is not None:
+					_, m, n = self._sizes
+					return self.values[(i * m + j) * n + k]  # 没有设置过值的位置为默认值
+			elif len(args) == 1 == len(atoms):
+				i = atoms[0].get(args[0])
+				if i is not None:
+					return self.values[i]
+			elif len(args) == 2 == len(atoms):
+				i, j = atoms[0].get(args[0]), atoms[1].get(args[1])
+				if i is not None and j is not None:
+					return self.values[i * self._sizes[1] + j]
+		except TypeError:  # 参数中含有list
+			pass
+		# 参数中含有str以外的类型， 或者有参数从未出现过
+		i = self.index(*args, create=False)
+		return self.default if i is None else self.values[i]
+
+	def keys(self):
+		return list(self._keys)
+
+	def items(self):
+		return [(key, self.values[self._offset(ids)]) for key, ids in zip(self._keys, self._entries)]
+
+	def __getitem__(self, key):
+		'''按str_key查找， 与以str_key为键的字典相同'''
+		n = self._by_key.get(str_key(key))
+		if n is None:
+			raise KeyError(key)
+		return self.values[self._offset(self._entries[n])]
+
+	def __setitem__(self, key, value):
+		self.set(value, key)
+
+	def __contains__(self, key):
+		return str_key(key) in self._by_key
+
+	def __len__(self):
+		return len(self._entries)
+
+	def copy(self):
+		table = KeyTable(self.default)
+		table._atoms = [atoms.copy() for atoms in self._atoms]
+		table._sizes = list(self._sizes)
+		table.values = list(self.values)
+		table._present = bytearray(self._present)
+		table._entries = list(self._entries)
+		table._keys = list(self._keys)
+		table._by_key = self._by_key.copy()
+		table.counters = self.counters
+		return table
+
+
 def set_dict(target_dict,value, *args):
-	target_dict[str_key(*args)] = value
+	if type(target_dict) is KeyTable:
+		target_dict.set(value, *args)
+	else:
+		target_dict[str_key(*args)] = value
 
 
 def get_dict(target_dict, *args):
+    if type(target_dict) is KeyTable:
+        return target_dict.get(*args)
     return target_dict.get(str_key(*args),0)
 
 def set_prob(P,s,a,s1,p=1.0):#设置概率字典
 	set_dict(P,p,s,a,s1)
 
 def get_prob(P,s,a,s1):#获取概率值
-	return P.get(str_key(s,a,s1), 0)
+	return get_dict(P,s,a,s1)
 
 def set_reward(R,s,a,r):#设置奖励值
 	set_dict(R,r,s,a)
 
 def get_reward(R,s,a):#获取奖励值
-	return R.get(str_key(s,a),0)
+	return get_dict(R,s,a)
 
 
 def display_dict(target_dict):#显示字典内容
-	for key in target_dict.keys():
-		print("{}: {:.2f}".format(key, target_dict[key]))
+	for key, value in target_dict.items():
+		print("{}: {:.2f}".format(key, value))
 	print("")
 
 
@@ -41,7 +205,7 @@ def set_value(V,s,v):#设置价值字典
 	set_dict(V,v,s)
 
 def get_value(V,s):#获取价值字典
-	return V.get(str_key(s),0)
+	return get_dict(V,s)
 
 
 def set_pi(Pi,s,a,p=0.5):#设置策略字典
@@ -49,4 +213,197 @@ def set_pi(Pi,s,a,p=0.5):#设置策略字典
 
 
 def get_pi(Pi,s,a):#获取策略（概率)值
-	return Pi.get(str_key(s,a),0)
\ No newline at end of file
+	if type(Pi) is TabularPolicy:
+		return Pi.prob(s, a)
+	return get_dict(Pi,s,a)
+
+
+class TabularPolicy():
+	'''以数组 pi[s,a] 存储的策略， 行为状态， 列为行为
+	可以直接作为MDP.py中的策略字典Pi(通过get_pi)以及ch03.py中的策略函数Pi(MDP, V, s, a)使用，
+	查询概率时只需两次字典查找得到索引， 复制、比较与保存都只涉及一个数组
+	'''
+
+	def __init__(self, S, A, pi=None):
+		self.S, self.A = list(S), list(A)
+		self.s_to_i = {s: i for i, s in enumerate(self.S)}
+		self.a_to_i = {a: i for i, a in enumerate(self.A)}
+		if pi is None:
+			pi = np.zeros((len(self.S), len(self.A)))
+		self.pi = np.array(pi, dtype=float)
+
+	@classmethod
+	def uniform(cls, S, A):
+		'''均一随机策略'''
+		return cls(S, A, np.full((len(S), len(A)), 1.0 / len(A)))
+
+	@classmethod
+	def deterministic(cls, S, A, actions):
+		'''确定性策略， actions为字典 状态 -> 行为， 或与S等长的行为列表， 未给出行为的状态概率全为0'''
+		policy = cls(S, A)
+		if not isinstance(actions, dict):
+			actions = dict(zip(policy.S, actions))
+		for s, a in actions.items():
+			policy.pi[policy.s_to_i[s], policy.a_to_i[a]] = 1.0
+		return policy
+
+	@classmethod
+	def greedy(cls, S, A, q, atol=1e-8):
+		'''根据行为价值数组 q shape(nS,nA) 得到贪婪策略， 多个行为的价值相差不超过atol时平分概率'''
+		q = np.asarray(q, dtype=float)
+		best = np.isclose(q, q.max(axis=1, keepdims=True), rtol=0, atol=atol)
+		return cls(S, A, best / best.sum(axis=1, keepdims=True))
+
+	@classmethod
+	def from_dict(cls, Pi, S, A):
+		'''由以str_key(s,a)为键的策略字典(或KeyTable)得到策略'''
+		policy = cls(S, A)
+		for i, s in enumerate(policy.S):
+			for j, a in enumerate(policy.A):
+				policy.pi[i, j] = get_dict(Pi, s, a)
+		return policy
+
+	def to_dict(self, Pi=None):
+		'''把概率不为0的项写入策略字典Pi， 默认新建一个KeyTable'''
+		Pi = KeyTable() if Pi is None else Pi
+		for i, j in zip(*np.nonzero(self.pi)):
+			set_dict(Pi, float(self.pi[i, j]), self.S[i], self.A[j])
+		return Pi
+
+	def prob(self, s, a):
+		return self.pi[self.s_to_i[s], self.a_to_i[a]]
+
+	def __call__(self, MDP, V, s, a):
+		'''与ch03.py中策略函数相同的调用方式'''
+		return self.pi[self.s_to_i[s], self.a_to_i[a]]
+
+	def __array__(self, dtype=None, copy=None):
+		return self.pi if dtype is None else self.pi.astype(dtype)
+
+	def __eq__(self, other):
+		return isinstance(other, TabularPolicy) and self.S == other.S \
+			and self.A == other.A and np.array_equal(self.pi, other.pi)
+
+	__hash__ = None
+
+	def copy(self):
+		return TabularPolicy(self.S, self.A, self.pi)
+
+	def save(self, path):
+		save_arrays(path, {"pi": self.pi}, {"type": "TabularPolicy", "S": self.S, "A": self.A})
+
+	@classmethod
+	def load(cls, path, mmap=True):
+		arrays, meta = load_arrays(path, mmap)
+		policy = cls(meta["S"], meta["A"])
+		policy.pi = arrays["pi"]
+		return policy
+
+
+INDEX_FILE = "index.json"
+
+
+def save_arrays(path, arrays, meta=None):
+	'''把多个数组保存到目录path中: 每个数组一个.npy文件， index.json中记录数组名与元数据
+	Args:
+		arrays 字典 名称 -> 数组
+		meta 可以序列化为JSON的元数据， 比如状态空间、行为空间与衰减因子
+	'''
+	os.makedirs(path, exist_ok=True)
+	for name, x in arrays.items():
+		np.save(os.path.join(path, name + ".npy"), np.asarray(x))
+	with open(os.path.join(path, INDEX_FILE), "w", encoding="utf-8") as f:
+		json.dump({"arrays": list(arrays), "meta": meta or {}}, f, ensure_ascii=False, indent=2)
+
+
+def load_arrays(path, mmap=True):
+	'''读取save_arrays保存的目录
+	Args:
+		mmap 为True时内存映射.npy文件而不读入内存， 修改数组不会写回文件
+	Returns:
+		tuple(arrays, meta)
+	'''
+	with open(os.path.join(path, INDEX_FILE), encoding="utf-8") as f:
+		index = json.load(f)
+	arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="c" if mmap else None)
+			  for name in index["arrays"]}
+	return arrays, index["meta"]
+
+
+class SolverProfiler():
+	'''动态规划求解过程的统计: 贝尔曼备份次数， 模型、价值与策略的查询次数， 每次迭代的耗时与最大残差
+	传给policy_evaluate/value_iterate的profiler参数即可， 不传时没有任何额外开销
+	'''
+
+	def __init__(self, callback=None):
+		self.counters = {}  # 名称 -> 调用次数
+		self.sweeps = []  # 每次迭代的记录 {"sweep", "seconds", "residual", "backups"}
+		self.callback = callback  # 每次迭代结束后调用 callback(record)
+		self._start = None
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def wrap(self, name, fn):
+		'''返回一个先计数再调用fn的函数'''
+		counters = self.counters
+
+		def counted(*args, **kwargs):
+			counters[name] = counters.get(name, 0) + 1
+			return fn(*args, **kwargs)
+		return counted
+
+	@contextmanager
+	def attach(self, namespace, names):
+		'''在with语句内把namespace(模块的globals())中的这些函数替换为计数的版本， 退出时还原'''
+		originals = {name: namespace[name] for name in names if name in namespace}
+		for name, fn in originals.items():
+			namespace[name] = self.wrap(name, fn)
+		try:
+			yield self
+		finally:
+			namespace.update(originals)
+
+	@contextmanager
+	def count_keys(self, *tables):
+		'''在with语句内统计这些KeyTable(及其复制得到的表)调用str_key的次数， 退出时还原;
+		其他类型的表以及其他KeyTable不受影响
+		'''
+		tables = [table for table in tables if type(table) is KeyTable]
+		originals = [table.counters for table in tables]
+		for table in tables:
+			table.counters = self.counters
+		try:
+			yield self
+		finally:
+			for table, counters in zip(tables, originals):
+				table.counters = counters
+
+	def start_sweep(self):
+		self._start = time.perf_counter()
+
+	def end_sweep(self, residual, backups):
+		'''记录一次迭代的耗时、最大残差以及备份的次数
+		backups 以状态为单位: 每更新一个状态的价值计一次， 与该状态有多少个行为无关
+		'''
+		record = {"sweep": len(self.sweeps),
+				  "seconds": time.perf_counter() - self._start,
+				  "residual": float(residual),
+				  "backups": int(backups)}
+		self.sweeps.append(record)
+		self.count("backups", backups)
+		if self.callback is not None:
+			self.callback(record)
+
+	def export(self):
+		return {"counters": dict(self.counters),
+				"seconds": sum(record["seconds"] for record in self.sweeps),
+				"sweeps": list(self.sweeps)}
+
+	def to_json(self, path=None):
+		'''导出为JSON字符串， 给定path时同时写入文件'''
+		text = json.dumps(self.export(), ensure_ascii=False)
+		if path is not None:
+			with open(path, "w", encoding="utf-8") as f:
+				f.write(text)
+		return text